@@ -1,12 +1,32 @@
 import os
-from flask import Flask, request, abort, jsonify, render_template
+from flask import Blueprint, Flask, Response, request, abort, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import logging
 from sqlalchemy import func
+from datetime import date
 from werkzeug.exceptions import HTTPException
-from models import db_drop_and_create_all, setup_db, Actor, Movie, Performance
+from models import (db, db_drop_and_create_all, setup_db, bulk_delete, fee_totals,
+                    Actor, Movie, Performance, MovieCosts, ActorEarnings)
+from sqlalchemy.orm import selectinload
 from auth.auth import AuthError, requires_auth
+from pagination import get_page_args, get_sort_args, paginate
+from filters import actor_filters, movie_filters, ACTOR_SORT_COLUMNS, MOVIE_SORT_COLUMNS
+from fields import (get_fieldset, serialize, ACTOR_FIELDS, MOVIE_FIELDS, CAST_FIELDS,
+                    FILMOGRAPHY_FIELDS)
+from streaming import ndjson_response
+from etag import conditional
+from response_cache import cached
+from search import search_index
+from pool import pool_stats, warm_pool
+from metrics import metrics, start_request, finish_request, CONTENT_TYPE
+from encoding import JSONEncoder, jsonify
+from compression import compress_response
+from replicas import get_replicas, pin_after_write, route_request, setup_replicas
+from profiler import enable_profiler, start_profile, finish_profile
+from config import database_config, search_config, report_config, profiler_config, replica_config
+from bulk import (bulk_create, bulk_patch, get_batch_size, get_bulk_ids, get_bulk_records,
+                  validate_actor, validate_actor_patch, validate_movie, validate_movie_patch)
 
 
 
@@ -14,12 +34,17 @@ from auth.auth import AuthError, requires_auth
 # App Config.
 #----------------------------------------------------------------------------#
 
-app = Flask(__name__)
-setup_db(app)
-CORS(app, resources={r"/*": {"origins": "*"}})
+# Routes, hooks and error handlers; create_app registers them on an app
+api = Blueprint('api', __name__)
 logging.basicConfig(filename="api.log", level=logging.ERROR)
 
-@app.after_request
+@api.before_app_request
+def start_request_timer():
+    start_request()
+    start_profile(request.url_rule.rule if request.url_rule else 'unmatched')
+    route_request()
+
+@api.after_app_request
 def after_request(response):
     """Modify response headers including Access-Control-* headers.
 
@@ -32,27 +57,55 @@ def after_request(response):
     response.headers.add(
         "Access-Control-Allow-Methods", "GET, POST, PATCH, DELETE, OPTIONS"
     )
+    response = pin_after_write(response)
+    response = compress_response(response)
+
+    # unmatched URLs share one label so scanners cannot grow the registry
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    finish_request(route, request.method, response.status_code)
+
+    profile = finish_profile()
+    if profile is not None and profiler_config['SERVER_TIMING']:
+        response.headers.add('Server-Timing', profile.server_timing())
     return response
 
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
-@app.route('/actors', methods=['GET'])
+@api.route('/actors', methods=['GET'])
 @requires_auth('get:actors')
+@conditional('actors')
+@cached('actors')
 def get_actors(payload):
+  limit, after = get_page_args(request.args)
+  sort, after = get_sort_args(request.args, ACTOR_SORT_COLUMNS, after)
+  criteria = actor_filters(request.args)
+  fieldset = get_fieldset(request.args, ACTOR_FIELDS, Actor.id, sort.column)
   try:
-      all_actors = Actor.query.order_by(Actor.id).all()
-      actors = [{"id":actor.id,"name": actor.name, "age": actor.age,
-                       "gender": actor.gender}
-                      for actor in all_actors]
+      # column tuples straight to dicts, no ORM instances or identity map
+      query = db.session.query(*fieldset.columns).filter(*criteria)
+      page, next_cursor = paginate(query, Actor.id, limit, after, sort)
+      actors = serialize(page, fieldset.names)
 
-      return jsonify({"success":True,"actors":actors})
+      return jsonify({"success":True,"actors":actors,
+                      "next_cursor":next_cursor})
 
   except Exception as e:
         logging.exception(e)
         abort(500)
 
-@app.route('/actors', methods=['POST'])
+@api.route('/actors/export', methods=['GET'])
+@requires_auth('get:actors')
+def export_actors(payload):
+    # column tuples skip ORM hydration and the eager join on performances
+    query = db.session.query(
+        Actor.id, Actor.name, Actor.age, Actor.gender).order_by(Actor.id)
+
+    return ndjson_response(query, lambda actor: {
+        "id": actor.id, "name": actor.name, "age": actor.age,
+        "gender": actor.gender})
+
+@api.route('/actors', methods=['POST'])
 @requires_auth('post:actor')
 def add_actor(payload):
     data = request.get_json()
@@ -76,7 +129,120 @@ def add_actor(payload):
         logging.exception(e)
         abort(500)
 
-@app.route('/actors/<int:actor_id>', methods=['PATCH'])
+@api.route('/actors/<int:actor_id>', methods=['GET'])
+@requires_auth('get:actors')
+@conditional('actors')
+def get_actor(payload, actor_id):
+    fieldset = get_fieldset(request.args, ACTOR_FIELDS)
+
+    actor = db.session.query(*fieldset.columns).filter(Actor.id == actor_id).one_or_none()
+
+    if actor is None:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'actor': dict(zip(fieldset.names, actor)),
+    }), 200
+
+@api.route('/actors/<int:actor_id>/movies', methods=['GET'])
+@requires_auth('get:actors')
+@conditional('movies', 'Performance')
+def get_actor_movies(payload, actor_id):
+    limit, after = get_page_args(request.args)
+    fieldset = get_fieldset(request.args, FILMOGRAPHY_FIELDS, Movie.id)
+
+    if db.session.query(Actor.id).filter(Actor.id == actor_id).scalar() is None:
+        abort(404)
+
+    try:
+        # one joined column query per page, whatever the size of the filmography
+        query = db.session.query(*fieldset.columns
+        ).select_from(Movie).join(Performance, Performance.c.Movie_id == Movie.id
+        ).filter(Performance.c.Actor_id == actor_id)
+        page, next_cursor = paginate(query, Movie.id, limit, after)
+
+        movies = serialize(page, fieldset.names)
+
+        return jsonify({
+            'success': True,
+            'actor_id': actor_id,
+            'movies': movies,
+            'next_cursor': next_cursor,
+        }), 200
+    except Exception as e:
+        logging.exception(e)
+        abort(500)
+
+@api.route('/actors/<int:actor_id>/earnings', methods=['GET'])
+@requires_auth('get:actors')
+@conditional('Performance')
+def get_actor_earnings(payload, actor_id):
+
+    if db.session.query(Actor.id).filter(Actor.id == actor_id).scalar() is None:
+        abort(404)
+
+    total, average, fee_count, cast_count = fee_totals(Performance.c.Actor_id, actor_id)
+
+    return jsonify({
+        'success': True,
+        'actor_id': actor_id,
+        'total_fee': total,
+        'average_fee': average,
+        'fee_count': fee_count,
+        'movie_count': cast_count,
+    }), 200
+
+@api.route('/actors/bulk', methods=['POST'])
+@requires_auth('post:actor')
+def add_actors_bulk(payload):
+    records = get_bulk_records(request.get_json())
+    batch_size = get_batch_size(request.args)
+
+    created, errors = bulk_create(Actor, records, validate_actor, batch_size)
+
+    return jsonify({
+        'success': bool(created),
+        'created': created,
+        'errors': errors,
+    }), 201 if created else 422
+
+@api.route('/actors/bulk', methods=['PATCH'])
+@requires_auth('patch:actor')
+def update_actors_bulk(payload):
+    records = get_bulk_records(request.get_json())
+
+    try:
+        updated, missing, errors = bulk_patch(Actor, records, validate_actor_patch)
+    except Exception as e:
+        logging.exception(e)
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'missing': missing,
+        'errors': errors,
+    }), 200
+
+@api.route('/actors/bulk', methods=['DELETE'])
+@requires_auth('delete:actor')
+def delete_actors_bulk(payload):
+    ids = get_bulk_ids(request.get_json())
+
+    try:
+        deleted, missing = bulk_delete(Actor, ids)
+    except Exception as e:
+        logging.exception(e)
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted,
+        'missing': missing,
+    }), 200
+
+@api.route('/actors/<int:actor_id>', methods=['PATCH'])
 @requires_auth('patch:actor')
 def update_actor(payload, actor_id):
 
@@ -115,11 +281,13 @@ def update_actor(payload, actor_id):
     except Exception:
         abort(422)
 
-@app.route('/actors/<int:actor_id>', methods=['DELETE'])
+@api.route('/actors/<int:actor_id>', methods=['DELETE'])
 @requires_auth('delete:actor')
 def delete_actor(payload, actor_id):
 
-    actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+    # the delete clears the Performance rows, so load them up front
+    actor = Actor.query.options(selectinload(Actor.performances)
+                                ).filter(Actor.id == actor_id).one_or_none()
 
     if actor is None:
         abort(404)
@@ -132,23 +300,41 @@ def delete_actor(payload, actor_id):
     }), 200
 
 
-@app.route('/movies', methods=['GET'])
+@api.route('/movies', methods=['GET'])
 @requires_auth('get:movies')
+@conditional('movies')
+@cached('movies')
 def get_movies(payload):
+    limit, after = get_page_args(request.args)
+    sort, after = get_sort_args(request.args, MOVIE_SORT_COLUMNS, after)
+    criteria = movie_filters(request.args)
+    fieldset = get_fieldset(request.args, MOVIE_FIELDS, Movie.id, sort.column)
     try:
-        all_movies = Movie.query.order_by(Movie.id).all()
+        query = db.session.query(*fieldset.columns).filter(*criteria)
+        page, next_cursor = paginate(query, Movie.id, limit, after, sort)
 
-        movies = [{"id":movie.id,"title": movie.title, "release_date": movie.release_date}
-                      for movie in all_movies]
+        movies = serialize(page, fieldset.names)
 
         return jsonify({
             'success': True,
             'movies': movies,
+            'next_cursor': next_cursor,
         }), 200
     except Exception:
         abort(422)
 
-@app.route('/movies', methods=['POST'])
+@api.route('/movies/export', methods=['GET'])
+@requires_auth('get:movies')
+def export_movies(payload):
+    query = db.session.query(
+        Movie.id, Movie.title, Movie.release_date).order_by(Movie.id)
+
+    return ndjson_response(query, lambda movie: {
+        "id": movie.id, "title": movie.title,
+        "release_date": movie.release_date.isoformat()
+        if movie.release_date is not None else None})
+
+@api.route('/movies', methods=['POST'])
 @requires_auth('post:movie')
 def add_movies(payload):
     data = request.get_json()
@@ -158,6 +344,12 @@ def add_movies(payload):
     if not all([title, release_date]):
       abort(400)
 
+    # JSON carries the date as an ISO 8601 string
+    try:
+        release_date = date.fromisoformat(release_date)
+    except (TypeError, ValueError):
+        abort(400)
+
     try:
         new_movie = Movie(
           title=title,
@@ -170,7 +362,120 @@ def add_movies(payload):
         logging.exception(e)
         abort(500)
 
-@app.route('/movies/<int:movie_id>', methods=['PATCH'])
+@api.route('/movies/<int:movie_id>', methods=['GET'])
+@requires_auth('get:movies')
+@conditional('movies')
+def get_movie(payload, movie_id):
+    fieldset = get_fieldset(request.args, MOVIE_FIELDS)
+
+    movie = db.session.query(*fieldset.columns).filter(Movie.id == movie_id).one_or_none()
+
+    if movie is None:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'movie': dict(zip(fieldset.names, movie)),
+    }), 200
+
+@api.route('/movies/<int:movie_id>/actors', methods=['GET'])
+@requires_auth('get:movies')
+@conditional('actors', 'Performance')
+def get_movie_actors(payload, movie_id):
+    limit, after = get_page_args(request.args)
+    fieldset = get_fieldset(request.args, CAST_FIELDS, Actor.id)
+
+    if db.session.query(Movie.id).filter(Movie.id == movie_id).scalar() is None:
+        abort(404)
+
+    try:
+        # one joined column query per page, whatever the size of the cast
+        query = db.session.query(*fieldset.columns
+        ).select_from(Actor).join(Performance, Performance.c.Actor_id == Actor.id
+        ).filter(Performance.c.Movie_id == movie_id)
+        page, next_cursor = paginate(query, Actor.id, limit, after)
+
+        actors = serialize(page, fieldset.names)
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'actors': actors,
+            'next_cursor': next_cursor,
+        }), 200
+    except Exception as e:
+        logging.exception(e)
+        abort(500)
+
+@api.route('/movies/<int:movie_id>/costs', methods=['GET'])
+@requires_auth('get:movies')
+@conditional('Performance')
+def get_movie_costs(payload, movie_id):
+
+    if db.session.query(Movie.id).filter(Movie.id == movie_id).scalar() is None:
+        abort(404)
+
+    total, average, fee_count, cast_count = fee_totals(Performance.c.Movie_id, movie_id)
+
+    return jsonify({
+        'success': True,
+        'movie_id': movie_id,
+        'total_fee': total,
+        'average_fee': average,
+        'fee_count': fee_count,
+        'cast_count': cast_count,
+    }), 200
+
+@api.route('/movies/bulk', methods=['POST'])
+@requires_auth('post:movie')
+def add_movies_bulk(payload):
+    records = get_bulk_records(request.get_json())
+    batch_size = get_batch_size(request.args)
+
+    created, errors = bulk_create(Movie, records, validate_movie, batch_size)
+
+    return jsonify({
+        'success': bool(created),
+        'created': created,
+        'errors': errors,
+    }), 201 if created else 422
+
+@api.route('/movies/bulk', methods=['PATCH'])
+@requires_auth('patch:movie')
+def update_movies_bulk(payload):
+    records = get_bulk_records(request.get_json())
+
+    try:
+        updated, missing, errors = bulk_patch(Movie, records, validate_movie_patch)
+    except Exception as e:
+        logging.exception(e)
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'missing': missing,
+        'errors': errors,
+    }), 200
+
+@api.route('/movies/bulk', methods=['DELETE'])
+@requires_auth('delete:movie')
+def delete_movies_bulk(payload):
+    ids = get_bulk_ids(request.get_json())
+
+    try:
+        deleted, missing = bulk_delete(Movie, ids)
+    except Exception as e:
+        logging.exception(e)
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted,
+        'missing': missing,
+    }), 200
+
+@api.route('/movies/<int:movie_id>', methods=['PATCH'])
 @requires_auth('patch:movie')
 def update_movie(payload, movie_id):
 
@@ -191,7 +496,7 @@ def update_movie(payload, movie_id):
             movie.title = new_title
 
         if new_release_date is not None:
-            movie.release_date = new_release_date
+            movie.release_date = date.fromisoformat(new_release_date)
 
         movie.update()
 
@@ -205,11 +510,13 @@ def update_movie(payload, movie_id):
     except Exception:
         abort(422)
 
-@app.route('/movies/<int:movie_id>', methods=['DELETE'])
+@api.route('/movies/<int:movie_id>', methods=['DELETE'])
 @requires_auth('delete:movie')
 def delete_moive(payload, movie_id):
 
-    movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+    # the delete clears the Performance rows, so load them up front
+    movie = Movie.query.options(selectinload(Movie.actors)
+                                ).filter(Movie.id == movie_id).one_or_none()
 
     if movie is None:
         abort(404)
@@ -222,9 +529,114 @@ def delete_moive(payload, movie_id):
     }), 200
 
 
+@api.route('/reports/top-fees', methods=['GET'])
+@requires_auth('get:movies')
+@conditional('Performance', 'actors', 'movies')
+def get_top_fees(payload):
+    by = request.args.get('by', 'movie')
+    try:
+        limit = int(request.args.get('limit', report_config['TOP_FEES_DEFAULT_LIMIT']))
+    except ValueError:
+        abort(400)
+    if by not in ('movie', 'actor') or limit < 1:
+        abort(400)
+    limit = min(limit, report_config['TOP_FEES_MAX_LIMIT'])
+
+    # the summary tables are indexed on fee_total, so this reads limit rows
+    if by == 'movie':
+        summary, key, record, label = MovieCosts, MovieCosts.c.Movie_id, Movie, Movie.title
+    else:
+        summary, key, record, label = ActorEarnings, ActorEarnings.c.Actor_id, Actor, Actor.name
+
+    try:
+        rows = db.session.query(
+            key, label, summary.c.fee_total, summary.c.fee_count, summary.c.cast_count
+        ).join(record, record.id == key
+        ).order_by(summary.c.fee_total.desc(), key).limit(limit).all()
+    except Exception as e:
+        logging.exception(e)
+        abort(500)
+
+    return jsonify({
+        'success': True,
+        'by': by,
+        'results': [{'id': id,
+                     ('title' if by == 'movie' else 'name'): text,
+                     'total_fee': total,
+                     'average_fee': total / fee_count if fee_count else None,
+                     'fee_count': fee_count,
+                     ('cast_count' if by == 'movie' else 'movie_count'): cast_count}
+                    for id, text, total, fee_count, cast_count in rows],
+    }), 200
+
+@api.route('/search', methods=['GET'])
+@requires_auth('get:actors')
+def search(payload):
+    query = request.args.get('q', '').strip()
+    try:
+        limit = int(request.args.get('limit', search_config['SEARCH_DEFAULT_LIMIT']))
+    except ValueError:
+        abort(400)
+    if not query or limit < 1:
+        abort(400)
+    limit = min(limit, search_config['SEARCH_MAX_LIMIT'])
+
+    # movie titles only for callers who may list movies
+    kinds = {'actor'}
+    if 'get:movies' in (payload.get('permissions') or ()):
+        kinds.add('movie')
+
+    try:
+        results = search_index.search(query, limit, kinds)
+    except Exception as e:
+        logging.exception(e)
+        abort(500)
+
+    return jsonify({
+        'success': True,
+        'results': [{'type': kind, 'id': id,
+                     ('name' if kind == 'actor' else 'title'): text}
+                    for kind, id, text in results],
+    }), 200
+
+
+@api.route('/instrumentation/pool', methods=['GET'])
+def get_pool_stats():
+    # no token, so monitoring can poll it; it only exposes counters
+    replicas = get_replicas()
+    return jsonify({
+        'success': True,
+        'pool': pool_stats(db.engine),
+        'replicas': [dict(stats, pool=pool_stats(replica.engine))
+                     for stats, replica in zip(replicas.stats(), replicas.replicas)],
+    }), 200
+
+
+@api.route('/ready', methods=['GET'])
+def ready():
+    # no token, so load balancers can poll it before sending traffic here
+    try:
+        connections = warm_pool(db.engine)
+    except Exception as e:
+        logging.exception(e)
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Database unavailable"
+        }), 503
+
+    return jsonify({'success': True, 'connections': connections}), 200
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format, for the requests this worker answered
+    return Response(metrics.render(), mimetype=CONTENT_TYPE)
+
+
 ## Error Handling
 '''
-Implement error handlers using the @app.errorhandler(error) decorator
+Implement error handlers using the @api.app_errorhandler(error) decorator
     each error handler should return (with approprate messages):
              jsonify({
                     "success": False, 
@@ -233,7 +645,7 @@ Implement error handlers using the @app.errorhandler(error) decorator
                     }), 404
 
 '''
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return jsonify({
         "success": False,
@@ -241,7 +653,7 @@ def bad_request(error):
         "message": "Bad Request"
     }), 400
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error):
     return jsonify({
         "success": False,
@@ -249,7 +661,7 @@ def unauthorized(error):
         "message": "Unauthorized"
     }), 401
 
-@app.errorhandler(403)
+@api.app_errorhandler(403)
 def forbidden(error):
     return jsonify({
         "success": False,
@@ -257,7 +669,7 @@ def forbidden(error):
         "message": "Forbidden"
     }), 403
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return jsonify({
         "success": False,
@@ -265,7 +677,7 @@ def not_found(error):
         "message": "Resource not found"
     }), 404
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(error):
     return jsonify({
         "success": False,
@@ -273,7 +685,15 @@ def method_not_allowed(error):
         "message": "Method not allowed"
     }), 405
 
-@app.errorhandler(422)
+@api.app_errorhandler(413)
+def payload_too_large(error):
+    return jsonify({
+        "success": False,
+        "error": 413,
+        "message": "Payload too large"
+    }), 413
+
+@api.app_errorhandler(422)
 def unprocessable(error):
     return jsonify({
         "success": False,
@@ -281,7 +701,7 @@ def unprocessable(error):
         "message": "Unprocessable"
     }), 422
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def unknown(error):
     return jsonify({
         "success": False,
@@ -289,7 +709,7 @@ def unknown(error):
         "message": "Unknown server error"
     }), 500
 
-@app.errorhandler(AuthError)
+@api.app_errorhandler(AuthError)
 def authentification_failed(AuthError): 
     return jsonify({
         "success": False, 
@@ -300,6 +720,36 @@ def authentification_failed(AuthError):
 
 
 
+#----------------------------------------------------------------------------#
+# App Factory.
+#----------------------------------------------------------------------------#
+
+def create_app(config=None):
+    '''
+        @INPUTS
+            config: Flask settings overriding the defaults of config.py (a dict),
+                    e.g. SQLALCHEMY_DATABASE_URI, SQLALCHEMY_REPLICA_URIS or TESTING
+
+        Builds the app without a database round trip: the schema belongs to
+        the migrations (python manage.py db upgrade) and the first connection
+        is opened by the first request, or by GET /ready.
+    '''
+    app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    app.config.update(config or {})
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI',
+                                 database_config['SQLALCHEMY_DATABASE_URI']))
+    setup_replicas(app, app.config.get('SQLALCHEMY_REPLICA_URIS',
+                                       replica_config['SQLALCHEMY_REPLICA_URIS']))
+    CORS(app, resources={r"/*": {"origins": "*"}})
+    app.register_blueprint(api)
+
+    if profiler_config['QUERY_PROFILER']:
+        enable_profiler()
+    return app
+
+app = create_app()
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
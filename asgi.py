@@ -0,0 +1,187 @@
+'''
+ASGI entry point, served by any ASGI server instead of gunicorn's sync workers:
+
+    uvicorn asgi:application --workers 2
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+
+Flask 1.0 and SQLAlchemy 1.3 have no asyncio support, so the routes, auth and
+error handlers of app.py run unchanged on a bounded thread pool, one thread
+per in-flight request. The event loop holds idle and slow connections, and
+the pool is sized to the database pool so a thread never waits for a
+connection. The JWKS keys are fetched at startup, before the first request.
+'''
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from app import app
+from auth.auth import jwks_cache
+from config import pool_config
+from models import dispose_engine
+
+# Responses are handed to the event loop in pieces of this size
+BODY_CHUNK_SIZE = 64 * 1024
+
+SERVER_ERROR_BODY = b'{"error":500,"message":"Unknown server error","success":false}\n'
+
+_END = object()
+
+class WSGIAdapter:
+    '''
+        @INPUTS
+            wsgi_app: the Flask application (any WSGI callable)
+            max_threads: requests run at the same time; the rest wait in the loop
+            startup: callables run on the pool when the server starts
+            shutdown: callables run on the pool when the server stops
+
+        An ASGI 3 application. Each request runs start to finish, streamed body
+        included, on one pool thread, so Flask's thread-local contexts and the
+        scoped SQLAlchemy session behave as under a threaded WSGI server.
+    '''
+    def __init__(self, wsgi_app, max_threads, startup=(), shutdown=()):
+        self.wsgi_app = wsgi_app
+        self.max_threads = max_threads
+        self.startup = list(startup)
+        self.shutdown = list(shutdown)
+        self.executor = ThreadPoolExecutor(max_threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                for callback in self.startup:
+                    await loop.run_in_executor(self.executor, callback)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for callback in self.shutdown:
+                    await loop.run_in_executor(self.executor, callback)
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_event_loop()
+        # a small queue, so a slow client pauses the thread producing the body
+        queue = asyncio.Queue(maxsize=4)
+        future = loop.run_in_executor(
+            self.executor, self._run, wsgi_environ(scope, bytes(body)), queue, loop)
+
+        connected = True
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if connected:
+                try:
+                    await send(item)
+                except Exception:
+                    # keep draining so the thread can finish and release its session
+                    connected = False
+        await future
+
+    def _run(self, environ, queue, loop):
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        response_start = []
+        def start_response(status, headers, exc_info=None):
+            response_start[:] = [{
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers],
+            }]
+
+        sent = False
+        result = None
+        try:
+            result = self.wsgi_app(environ, start_response)
+            pending = []
+            size = 0
+            for chunk in result:
+                pending.append(chunk)
+                size += len(chunk)
+                if size >= BODY_CHUNK_SIZE:
+                    if not sent:
+                        put(response_start[0])
+                        sent = True
+                    put({'type': 'http.response.body', 'body': b''.join(pending), 'more_body': True})
+                    pending = []
+                    size = 0
+            if not sent:
+                put(response_start[0])
+                sent = True
+            put({'type': 'http.response.body', 'body': b''.join(pending)})
+        except Exception as e:
+            logging.exception(e)
+            if not sent:
+                # same body as the app's 500 handler
+                put({'type': 'http.response.start', 'status': 500,
+                     'headers': [(b'content-type', b'application/json')]})
+                put({'type': 'http.response.body', 'body': SERVER_ERROR_BODY})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            put(_END)
+
+def wsgi_environ(scope, body):
+    '''the WSGI environ for an ASGI http scope and its complete request body'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def _warm_jwks():
+    jwks_cache.refresh()
+
+def create_asgi_app(wsgi_app, max_threads=None):
+    '''wraps wsgi_app with one thread per pooled database connection'''
+    if max_threads is None:
+        max_threads = pool_config['DB_POOL_SIZE'] + pool_config['DB_MAX_OVERFLOW']
+    return WSGIAdapter(wsgi_app, max_threads,
+                       startup=[_warm_jwks], shutdown=[dispose_engine])
+
+
+application = create_asgi_app(app)
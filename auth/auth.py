@@ -2,15 +2,26 @@ import json
 from flask import request, _request_ctx_stack, abort, current_app
 from functools import wraps
 
-from urllib.request import urlopen
 from jose import jwt
+from jose.utils import base64url_decode
 import logging
 
+from auth.jwks import JWKSCache, URLKeySource
+from auth.token_cache import TokenCache, VerifiedToken
+from metrics import timed
+
 
 AUTH0_DOMAIN = 'dev-maxdeveloper.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'Casting_Agency'
 
+# Process-wide JWKS cache, shared by every request in the worker
+jwks_cache = JWKSCache(
+    URLKeySource(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'))
+
+# Verified tokens, so a reused bearer token skips signature verification
+token_cache = TokenCache()
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -69,69 +80,82 @@ def check_permissions(permission, payload):
     '''
         @INPUTS
             permission: string permission (i.e. 'post:drink')
-            payload: decoded jwt payload
+            payload: decoded jwt payload or a VerifiedToken from token_cache
 
         Raise an AuthError if permissions are not included in the payload
             !!NOTE check your RBAC settings in Auth0
         Raise an AuthError if the requested permission string is not in the payload permissions array
         return true otherwise
     '''
+    if isinstance(payload, VerifiedToken):
+        return permission in payload.permissions
+
     permissions = payload.get('permissions')
     if permissions and permission in permissions:
         return True
 
     return False
 
+def skip_verification():
+    '''return true when testing without ?verify_token, where claims are trusted as-is'''
+    return bool(current_app.config.get('TESTING')) and not request.args.get('verify_token')
+
+def verify_signature(token, header, key):
+    '''
+        @INPUTS
+            token: a json web token (string)
+            header: the unverified header of the token
+            key: a parsed jose key from the JWKS cache
+
+        Raise a JWTError if the algorithm is not allowed or the signature does not match
+    '''
+    if header.get('alg') not in ALGORITHMS:
+        raise jwt.JWTError('The specified alg value is not allowed')
+
+    signing_input, _, signature = token.rpartition('.')
+    if not key.verify(signing_input.encode('utf-8'),
+                      base64url_decode(signature.encode('utf-8'))):
+        raise jwt.JWTError('Signature verification failed.')
+
 def verify_decode_jwt(token):
     '''
         @INPUTS
             token: a json web token (string)
 
         it should be an Auth0 token with key id (kid)
-        it should verify the token using Auth0 /.well-known/jwks.json
+        it should verify the token using Auth0 /.well-known/jwks.json (cached in jwks_cache)
         it should decode the payload from the token
         it should validate the claims
         return the decoded payload
 
         !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
     '''
-    if current_app.config.get('TESTING'):
-        if not request.args.get('verify_token'):
-            return jwt.get_unverified_claims(token)
-
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    if skip_verification():
+        return jwt.get_unverified_claims(token)
 
     # Get the data in the header
     unverified_header = jwt.get_unverified_header(token)
 
     # choose our key
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
-    if rsa_key:
+    key = jwks_cache.get_key(unverified_header['kid'])
+
+    if key is not None:
         try:
-            # use the key to validate the jwt
+            # use the pre-parsed key to validate the signature, then the claims
+            verify_signature(token, unverified_header, key)
             payload = jwt.decode(
                 token,
-                rsa_key,
+                '',
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
             return payload
 
@@ -162,28 +186,49 @@ def verify_decode_jwt(token):
 
     
 
+def get_verified_token(token):
+    '''
+        @INPUTS
+            token: a json web token (string)
+
+        return a VerifiedToken, from token_cache when the token was seen before
+        only tokens that went through verify_decode_jwt verification are cached
+    '''
+    verified = token_cache.get(token)
+    if verified is not None:
+        return verified
+
+    payload = verify_decode_jwt(token)
+    if skip_verification():
+        return VerifiedToken.from_payload(payload)
+
+    return token_cache.put(token, payload)
+
 def requires_auth(permission=''):
     '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
     get_token_auth_header method to get the token
-    verify_decode_jwt method to decode the jwt
+    get_verified_token method to decode the jwt (verify_decode_jwt on a cache miss)
     check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
     '''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            if not check_permissions(permission, payload):
-                raise AuthError({
-                    'code': 'no_permission',
-                    'description': 'No Permission'
-                }, 401)
-
-            return f(payload, *args, **kwargs)
+            with timed('auth'):
+                token = get_token_auth_header()
+                verified = get_verified_token(token)
+                if not check_permissions(permission, verified):
+                    raise AuthError({
+                        'code': 'no_permission',
+                        'description': 'No Permission'
+                    }, 401)
+
+            # read by code outside the view, e.g. the replica routing
+            _request_ctx_stack.top.current_user = verified.payload
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,157 @@
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+
+## Key Sources
+'''
+Key Sources
+Anything with a fetch() method returning a JWKS document ({"keys": [...]})
+can feed the cache, so tests and offline environments never touch Auth0.
+'''
+class URLKeySource:
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+class FileKeySource:
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as jwks_file:
+            return json.load(jwks_file)
+
+
+class StaticKeySource:
+    def __init__(self, jwks):
+        self.jwks = jwks
+
+    def fetch(self):
+        return self.jwks
+
+
+## JWKS Cache
+class JWKSCache:
+    '''
+        @INPUTS
+            source: a key source (URLKeySource, FileKeySource, StaticKeySource)
+            ttl: seconds a fetched key set is considered fresh
+            stale_ttl: seconds past the ttl during which the old keys are still
+                served while a background refresh revalidates them
+            min_refresh_interval: minimum seconds between refreshes forced by
+                an unknown kid, so forged headers cannot hammer the source
+            algorithm: algorithm used to construct keys that carry no "alg"
+
+        Holds the parsed jose key objects per kid. A failed fetch keeps the
+        previous keys, so an identity provider outage does not take the API down.
+    '''
+    def __init__(self, source, ttl=600, stale_ttl=3600,
+                 min_refresh_interval=30, algorithm='RS256', clock=time.monotonic):
+        self.source = source
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.algorithm = algorithm
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._fetched_at = None
+        self._last_refresh_attempt = None
+        # counts fetch attempts, so threads can tell one happened while they waited
+        self._attempts = 0
+        self._revalidating = False
+
+    def use_source(self, source):
+        '''swap the key source and drop every cached key'''
+        with self._lock:
+            self.source = source
+            self._keys = {}
+            self._fetched_at = None
+            self._last_refresh_attempt = None
+
+    def get_key(self, kid):
+        '''
+            return the parsed key for kid, or None if the key set does not have it
+        '''
+        now = self._clock()
+        # read before _fetched_at: _fetch counts an attempt once it is over
+        attempts = self._attempts
+        fetched_at = self._fetched_at
+
+        if fetched_at is None or now - fetched_at > self.ttl + self.stale_ttl:
+            self._refresh_unless_attempted_since(attempts)
+        elif now - fetched_at > self.ttl:
+            self._revalidate_in_background()
+
+        attempts = self._attempts
+        key = self._keys.get(kid)
+        if key is None and self._may_force_refresh(now):
+            self._refresh_unless_attempted_since(attempts)
+            key = self._keys.get(kid)
+
+        return key
+
+    def refresh(self):
+        '''fetch and parse the key set; keeps the current keys on failure'''
+        with self._lock:
+            return self._fetch()
+
+    def _refresh_unless_attempted_since(self, attempts):
+        # threads that queued behind a fetch reuse its result instead of
+        # fetching the same key set once each
+        with self._lock:
+            if self._attempts != attempts:
+                return True
+            return self._fetch()
+
+    def _fetch(self):
+        self._last_refresh_attempt = self._clock()
+        try:
+            jwks = self.source.fetch()
+            self._keys = self._parse(jwks)
+            self._fetched_at = self._clock()
+        except Exception as e:
+            logging.exception(e)
+            return False
+        finally:
+            self._attempts += 1
+        return True
+
+    def _may_force_refresh(self, now):
+        last = self._last_refresh_attempt
+        return last is None or now - last >= self.min_refresh_interval
+
+    def _revalidate_in_background(self):
+        with self._lock:
+            if self._revalidating:
+                return
+            self._revalidating = True
+
+        def revalidate():
+            try:
+                self.refresh()
+            finally:
+                self._revalidating = False
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def _parse(self, jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, key.get('alg', self.algorithm))
+            except Exception as e:
+                logging.exception(e)
+        return keys
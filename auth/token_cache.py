@@ -0,0 +1,94 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+## Verified Token
+'''
+VerifiedToken
+A decoded payload that already passed signature and claims verification,
+with its permissions pre-converted to a frozenset for O(1) checks.
+'''
+class VerifiedToken(namedtuple('VerifiedToken', ['payload', 'permissions', 'expires_at'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(payload, frozenset(payload.get('permissions') or ()), payload.get('exp'))
+
+
+## Token Cache
+class TokenCache:
+    '''
+        @INPUTS
+            maxsize: maximum number of verified tokens kept (least recently used go first)
+
+        Keyed by the SHA-256 digest of the raw token, so the bearer strings
+        themselves are never held in memory. Every entry expires at the
+        token's own exp claim and is never returned after that.
+    '''
+    def __init__(self, maxsize=4096, clock=time.time):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        '''return the cached VerifiedToken for token, or None'''
+        key = self._digest(token)
+        with self._lock:
+            verified = self._entries.get(key)
+            if verified is None:
+                self.misses += 1
+                return None
+
+            if verified.expires_at <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return verified
+
+    def put(self, token, payload):
+        '''
+            cache a verified payload and return it as a VerifiedToken
+            payloads without an exp claim are returned but not cached
+        '''
+        verified = VerifiedToken.from_payload(payload)
+        if not isinstance(verified.expires_at, (int, float)) or self.maxsize <= 0:
+            return verified
+
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = verified
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return verified
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,820 @@
+'''
+Benchmark of every route in app.py
+
+    python benchmark.py --size 1k --output baseline.json
+    python benchmark.py --size 1k --baseline baseline.json
+    python benchmark.py --size 1k --concurrency 10,50 --db-latency-ms 2
+
+Seeds a scratch database (SQLite unless --database-url says otherwise), drives
+each route through the Flask test client with token verification stubbed
+(TESTING mode, executive producer claims), and reports throughput, latency
+percentiles and peak Python memory per route, and the cold start of a new
+process. Results are written as JSON; with --baseline the run fails on p95,
+throughput, metrics overhead or cold start regressions. With --concurrency the read routes are
+also sent through asgi.py, many at a time.
+'''
+import argparse
+import asyncio
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from urllib.parse import quote
+from datetime import date, datetime
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+DEFAULT_DATABASE = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'casting_agency_benchmark.db')
+
+#----------------------------------------------------------------------------#
+# Scenarios
+#----------------------------------------------------------------------------#
+
+# request(run) returns (path, JSON body or None); share scales the request count;
+# creates names the table whose new ids the delete scenarios remove
+Scenario = namedtuple('Scenario', ['method', 'rule', 'phase', 'request', 'share', 'creates'],
+                      defaults=(None,))
+
+def _actor(run):
+    return {'name': 'Bench Actor', 'gender': run.rng.choice(('Female', 'Male')),
+            'age': run.rng.randint(8, 90)}
+
+def _movie(run):
+    return {'title': 'Bench Movie',
+            'release_date': date(run.rng.randint(1950, 2024), 1, 1).isoformat()}
+
+def _created_ids(run, kind, count):
+    '''the last count ids the write scenarios created, which are forgotten'''
+    ids = run.created[kind][-count:]
+    del run.created[kind][-count:]
+    return ids
+
+def _created_id(run, kind):
+    # 0 matches no row: the delete then counts as an error
+    ids = _created_ids(run, kind, 1)
+    return ids[0] if ids else 0
+
+SCENARIOS = [
+    # reads run first, on the seeded data
+    Scenario('GET', '/actors', 'read',
+             lambda run: ('/actors?min_age={}'.format(run.rng.randint(8, 90)), None), 1),
+    Scenario('GET', '/actors/export', 'read', lambda run: ('/actors/export', None), 0.02),
+    Scenario('GET', '/actors/<int:actor_id>', 'read',
+             lambda run: ('/actors/{}'.format(run.actor_id()), None), 1),
+    Scenario('GET', '/actors/<int:actor_id>/movies', 'read',
+             lambda run: ('/actors/{}/movies'.format(run.actor_id()), None), 1),
+    Scenario('GET', '/actors/<int:actor_id>/earnings', 'read',
+             lambda run: ('/actors/{}/earnings'.format(run.actor_id()), None), 1),
+    Scenario('GET', '/movies', 'read',
+             lambda run: ('/movies?release_date_from={}-01-01'.format(run.rng.randint(1950, 2024)), None), 1),
+    Scenario('GET', '/movies/export', 'read', lambda run: ('/movies/export', None), 0.02),
+    Scenario('GET', '/movies/<int:movie_id>', 'read',
+             lambda run: ('/movies/{}'.format(run.movie_id()), None), 1),
+    Scenario('GET', '/movies/<int:movie_id>/actors', 'read',
+             lambda run: ('/movies/{}/actors'.format(run.movie_id()), None), 1),
+    Scenario('GET', '/movies/<int:movie_id>/costs', 'read',
+             lambda run: ('/movies/{}/costs'.format(run.movie_id()), None), 1),
+    Scenario('GET', '/reports/top-fees', 'read',
+             lambda run: ('/reports/top-fees?by={}'.format(run.rng.choice(('movie', 'actor'))), None), 1),
+    Scenario('GET', '/search', 'read',
+             lambda run: ('/search?q={}'.format(run.rng.choice(run.search_terms)), None), 1),
+    Scenario('GET', '/instrumentation/pool', 'read', lambda run: ('/instrumentation/pool', None), 1),
+    Scenario('GET', '/metrics', 'read', lambda run: ('/metrics', None), 1),
+    Scenario('GET', '/ready', 'read', lambda run: ('/ready', None), 1),
+    # writes add exactly the rows the deletes remove afterwards
+    Scenario('POST', '/actors', 'write', lambda run: ('/actors', _actor(run)), 1, 'actors'),
+    Scenario('POST', '/actors/bulk', 'write',
+             lambda run: ('/actors/bulk', [_actor(run) for _ in range(run.bulk_size)]), 1, 'actors'),
+    Scenario('PATCH', '/actors/<int:actor_id>', 'write',
+             lambda run: ('/actors/{}'.format(run.actor_id()), {'age': run.rng.randint(8, 90)}), 1),
+    Scenario('PATCH', '/actors/bulk', 'write',
+             lambda run: ('/actors/bulk', [{'id': run.actor_id(), 'age': run.rng.randint(8, 90)}
+                                           for _ in range(run.bulk_size)]), 1),
+    Scenario('POST', '/movies', 'write', lambda run: ('/movies', _movie(run)), 1, 'movies'),
+    Scenario('POST', '/movies/bulk', 'write',
+             lambda run: ('/movies/bulk', [_movie(run) for _ in range(run.bulk_size)]), 1, 'movies'),
+    Scenario('PATCH', '/movies/<int:movie_id>', 'write',
+             lambda run: ('/movies/{}'.format(run.movie_id()), {'title': 'Bench Sequel'}), 1),
+    Scenario('PATCH', '/movies/bulk', 'write',
+             lambda run: ('/movies/bulk', [{'id': run.movie_id(), 'title': 'Bench Sequel'}
+                                           for _ in range(run.bulk_size)]), 1),
+    # deletes take only the ids the writes created, so seeded rows survive
+    Scenario('DELETE', '/actors/<int:actor_id>', 'delete',
+             lambda run: ('/actors/{}'.format(_created_id(run, 'actors')), None), 1),
+    Scenario('DELETE', '/actors/bulk', 'delete',
+             lambda run: ('/actors/bulk', {'ids': _created_ids(run, 'actors', run.bulk_size)}), 1),
+    Scenario('DELETE', '/movies/<int:movie_id>', 'delete',
+             lambda run: ('/movies/{}'.format(_created_id(run, 'movies')), None), 1),
+    Scenario('DELETE', '/movies/bulk', 'delete',
+             lambda run: ('/movies/bulk', {'ids': _created_ids(run, 'movies', run.bulk_size)}), 1),
+]
+
+def missing_scenarios(app):
+    '''returns the "METHOD rule" of every route of app without a scenario'''
+    covered = {(scenario.method, scenario.rule) for scenario in SCENARIOS}
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (method, rule.rule) not in covered:
+                missing.append('{} {}'.format(method, rule.rule))
+    return missing
+
+class Run:
+    '''the state scenarios draw their requests from'''
+    def __init__(self, actors, movies, bulk_size, seed):
+        self.rng = random.Random(seed)
+        self.actors = actors
+        self.movies = movies
+        self.bulk_size = bulk_size
+        # ids created by the write scenarios, per table
+        self.created = {'actors': [], 'movies': []}
+        self.search_terms = ('ada', 'jack', 'maya chen', 'dark', 'golden riv', 'storm')
+
+    def actor_id(self):
+        return self.rng.randint(1, self.actors)
+
+    def movie_id(self):
+        return self.rng.randint(1, self.movies)
+
+#----------------------------------------------------------------------------#
+# Measurement
+#----------------------------------------------------------------------------#
+
+def percentile(sorted_values, p):
+    '''nearest-rank percentile of an already sorted list'''
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(latencies, errors, peak_memory):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'peak_memory_kb': peak_memory / 1024,
+    }
+
+def run_scenario(client, headers, run, scenario, requests, memory_requests):
+    def send():
+        path, body = scenario.request(run)
+        start = time.perf_counter()
+        response = client.open(path, method=scenario.method, headers=headers, json=body)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        if scenario.creates and response.status_code == 201:
+            created = response.get_json()
+            # a single create returns the row, a bulk one {id, index} per new row
+            run.created[scenario.creates].extend(
+                [row['id'] for row in created['created']] if 'created' in created else [created['id']])
+        return elapsed, response.status_code
+
+    if scenario.phase == 'read':
+        send()
+
+    latencies = []
+    errors = 0
+    for _ in range(requests):
+        elapsed, status = send()
+        latencies.append(elapsed)
+        errors += status >= 400
+
+    # a few more requests under tracemalloc, which would skew the timings above
+    tracemalloc.start()
+    for _ in range(memory_requests):
+        send()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return summarize(latencies, errors, peak_memory)
+
+def measure_bulk_insert(rows, batch_size):
+    '''rows per second of models.bulk_insert and models.bulk_delete, which
+    the bulk endpoints wrap; the inserted rows are deleted again'''
+    from models import Actor, bulk_delete, bulk_insert
+
+    records = [(index, {'name': 'Bulk Actor', 'gender': 'Female', 'age': 30})
+               for index in range(rows)]
+    start = time.perf_counter()
+    ids, failed = bulk_insert(Actor, records, batch_size)
+    insert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bulk_delete(Actor, list(ids.values()))
+    delete_seconds = time.perf_counter() - start
+
+    return {
+        'rows': rows,
+        'batch_size': batch_size,
+        'failed': len(failed),
+        'insert_rows_per_second': len(ids) / insert_seconds if insert_seconds else 0.0,
+        'delete_rows_per_second': len(ids) / delete_seconds if delete_seconds else 0.0,
+    }
+
+def measure_projection(rows, repeat=3):
+    '''
+    CPU time and peak Python memory, per 10k rows, of building the /actors
+    list from ORM instances (as before fields.py), from column tuples, and
+    from the two columns of ?fields=id,name
+    '''
+    from sqlalchemy.orm import lazyload
+    from fields import ACTOR_FIELDS, get_fieldset, serialize
+    from models import db, Actor
+    from werkzeug.datastructures import MultiDict
+
+    def orm():
+        actors = Actor.query.options(lazyload('*')).order_by(Actor.id).limit(rows).all()
+        return [{'id': actor.id, 'name': actor.name, 'age': actor.age, 'gender': actor.gender}
+                for actor in actors]
+
+    def projected(args):
+        fieldset = get_fieldset(MultiDict(args), ACTOR_FIELDS, Actor.id)
+        query = db.session.query(*fieldset.columns).order_by(Actor.id).limit(rows)
+        return lambda: serialize(query, fieldset.names)
+
+    results = {}
+    for name, build in (('orm', orm), ('columns', projected({})),
+                        ('fields_id_name', projected({'fields': 'id,name'}))):
+        cpu = []
+        for _ in range(repeat):
+            start = time.process_time()
+            count = len(build())
+            cpu.append(time.process_time() - start)
+            # no instance outlives its run in the identity map
+            db.session.remove()
+
+        tracemalloc.start()
+        build()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        db.session.remove()
+
+        scale = 10000 / count if count else 0.0
+        results[name] = {
+            'rows': count,
+            'cpu_ms_per_10k': min(cpu) * 1000 * scale,
+            'peak_memory_kb_per_10k': peak / 1024 * scale,
+        }
+    return results
+
+#----------------------------------------------------------------------------#
+# Metrics overhead
+#----------------------------------------------------------------------------#
+
+def measure_metrics_overhead(requests=10000, repeat=3):
+    '''
+    wall time per request, in microseconds, of what metrics.py adds to each
+    request: timing one phase and recording the request in the registry
+    '''
+    from metrics import Metrics, RequestTimer, timed
+
+    registry = Metrics()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(requests):
+            timer = RequestTimer(time.perf_counter())
+            with timed('auth'):
+                pass
+            registry.record('/actors', 'GET', 200, timer, time.perf_counter())
+        runs.append(time.perf_counter() - start)
+    return {'requests': requests, 'recording_us': min(runs) / requests * 1e6}
+
+#----------------------------------------------------------------------------#
+# Cold start
+#----------------------------------------------------------------------------#
+
+# Run in a fresh interpreter: what a new worker goes through before serving
+COLD_START_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+status = app.test_client().get('/ready').status_code
+ready = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'first_response_ms': (ready - imported) * 1000, 'status': status}))
+'''
+
+def measure_cold_start(database_url, runs):
+    '''
+    medians over runs new processes of importing app.py (import_ms), of the
+    first GET /ready, which opens the pool (first_response_ms), and of the
+    whole process including interpreter startup (process_ms)
+    '''
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', COLD_START_SCRIPT], stdout=subprocess.PIPE, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, DATABASE_URL=database_url)).stdout
+        sample = json.loads(output.decode('utf-8').splitlines()[-1])
+        sample['process_ms'] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+
+    results = {key: statistics.median(sample[key] for sample in samples)
+               for key in ('import_ms', 'first_response_ms', 'process_ms')}
+    results['errors'] = sum(sample['status'] != 200 for sample in samples)
+    return results
+
+#----------------------------------------------------------------------------#
+# Concurrency
+#----------------------------------------------------------------------------#
+
+def current_rss_kb():
+    '''resident set size now on Linux, the peak elsewhere'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+async def asgi_request(application, method, path, headers, body=None):
+    '''sends one request straight to an ASGI application, returns the status'''
+    path, _, query = path.partition('?')
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in headers.items()]
+    payload = b''
+    if body is not None:
+        payload = json.dumps(body).encode('utf-8')
+        headers.append((b'content-type', b'application/json'))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'root_path': '',
+        'query_string': query.encode('latin-1'), 'headers': headers,
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+    }
+    messages = [{'type': 'http.request', 'body': payload}]
+    statuses = []
+
+    async def receive():
+        return messages.pop() if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await application(scope, receive, send)
+    return statuses[0]
+
+def _concurrency_summary(concurrency, wall, latencies, errors):
+    latencies = sorted(latencies)
+    rss = current_rss_kb()
+    return {
+        'concurrency': concurrency,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'errors': errors,
+        'rss_kb': rss,
+        # requests a gigabyte of worker memory keeps in flight
+        'in_flight_per_gb': concurrency * 1024 * 1024 / rss,
+    }
+
+def measure_concurrency(client, application, headers, run, levels, requests, db_latency):
+    '''
+    the read scenarios on one sync worker (one request at a time) and on the
+    ASGI entry point at each concurrency level; db_latency seconds are added
+    to every statement to stand in for the network round trip to PostgreSQL
+    '''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if scenario.phase == 'read' and scenario.share == 1]
+
+    def next_request(i):
+        scenario = scenarios[i % len(scenarios)]
+        path, body = scenario.request(run)
+        return scenario.method, path, body
+
+    def wait_for_database(*args):
+        time.sleep(db_latency)
+
+    if db_latency:
+        event.listen(Engine, 'before_cursor_execute', wait_for_database)
+    try:
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        for i in range(requests):
+            method, path, body = next_request(i)
+            sent = time.perf_counter()
+            response = client.open(path, method=method, headers=headers, json=body)
+            response.get_data()
+            latencies.append(time.perf_counter() - sent)
+            errors += response.status_code >= 400
+        results = {'sync': _concurrency_summary(1, time.perf_counter() - start, latencies, errors)}
+
+        for level in levels:
+            async def drive():
+                pending = iter(range(requests))
+                latencies = []
+                errors = [0]
+
+                async def worker():
+                    for i in pending:
+                        method, path, body = next_request(i)
+                        sent = time.perf_counter()
+                        status = await asgi_request(application, method, path, headers, body)
+                        latencies.append(time.perf_counter() - sent)
+                        errors[0] += status >= 400
+
+                start = time.perf_counter()
+                await asyncio.gather(*(worker() for _ in range(level)))
+                return time.perf_counter() - start, latencies, errors[0]
+
+            wall, latencies, errors = asyncio.run(drive())
+            results['asgi_{}'.format(level)] = _concurrency_summary(level, wall, latencies, errors)
+    finally:
+        if db_latency:
+            event.remove(Engine, 'before_cursor_execute', wait_for_database)
+
+    return results
+
+#----------------------------------------------------------------------------#
+# Server load
+#----------------------------------------------------------------------------#
+
+def load_test_app(db_latency=0):
+    '''
+    the app gunicorn serves for --server-load: tokens are trusted as in the
+    rest of the benchmark, and every statement waits db_latency seconds
+    '''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import create_app
+
+    if db_latency:
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def wait_for_database(*args):
+            time.sleep(db_latency)
+
+    return create_app({'TESTING': True})
+
+def process_memory_kb(pid):
+    '''
+    proportional set size of pid, which splits the pages a preloaded master
+    shares with its workers between them; the RSS where it is not available
+    '''
+    for name, field in (('smaps_rollup', 'Pss:'), ('status', 'VmRSS:')):
+        try:
+            with open('/proc/{}/{}'.format(pid, name)) as source:
+                for line in source:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat:
+                # the parent pid follows the state, after the parenthesised name
+                if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def _http_get(port, path, headers, timeout=30):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request('GET', quote(path, safe='/?=&'), headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+def measure_server(worker_class, workers, database_url, paths, headers, clients, db_latency):
+    '''
+    starts gunicorn with gunicorn.conf.py and worker_class, sends paths from
+    clients threads at once, and reports throughput, p95 and the memory of
+    the master and its workers, also as requests per second per GB
+    '''
+    port = _free_port()
+    server = subprocess.Popen(
+        # gunicorn 20.0 cannot be run with -m
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '--bind', '127.0.0.1:{}'.format(port),
+         '--log-level', 'warning', 'benchmark:load_test_app(db_latency={!r})'.format(db_latency)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY=str(workers),
+                 DATABASE_URL=database_url))
+    latencies = []
+    statuses = []
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if _http_get(port, '/ready', {}, timeout=1) == 200:
+                    break
+            except OSError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('gunicorn with {} workers did not start'.format(worker_class))
+            time.sleep(0.1)
+
+        pending = iter(paths)
+
+        def client():
+            for path in pending:
+                sent = time.perf_counter()
+                try:
+                    status = _http_get(port, path, headers)
+                except (OSError, http.client.HTTPException):
+                    status = 599
+                latencies.append(time.perf_counter() - sent)
+                statuses.append(status)
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+        memory = sum(process_memory_kb(pid) for pid in [server.pid] + child_pids(server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    latencies.sort()
+    throughput = len(latencies) / wall if wall else 0.0
+    return {
+        'worker_class': worker_class,
+        'workers': workers,
+        'clients': clients,
+        'throughput_rps': throughput,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'errors': sum(status >= 400 for status in statuses),
+        'memory_kb': memory,
+        'rps_per_gb': throughput * 1024 * 1024 / memory if memory else 0.0,
+    }
+
+#----------------------------------------------------------------------------#
+# Baseline comparison
+#----------------------------------------------------------------------------#
+
+def compare(results, baseline, tolerance):
+    '''
+    returns a message per route that answered with errors, or whose p95 grew
+    or throughput fell by more than tolerance
+    '''
+    regressions = []
+    for name, current in results['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        # a failing route can look fast; no error is tolerated
+        if current.get('errors', 0):
+            regressions.append('{}: {} errors, baseline {}'.format(
+                name, current['errors'], before.get('errors', 0) if before else 'none'))
+        if not before:
+            continue
+        if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f} ms, baseline {:.2f} ms'.format(
+                name, current['p95_ms'], before['p95_ms']))
+        if current['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} req/s, baseline {:.1f} req/s'.format(
+                name, current['throughput_rps'], before['throughput_rps']))
+
+    current, before = results.get('bulk_insert'), baseline.get('bulk_insert')
+    if current and before and (current['insert_rows_per_second']
+                               < before['insert_rows_per_second'] * (1 - tolerance)):
+        regressions.append('bulk insert: {:.0f} rows/s, baseline {:.0f} rows/s'.format(
+            current['insert_rows_per_second'], before['insert_rows_per_second']))
+
+    current, before = results.get('metrics_overhead'), baseline.get('metrics_overhead')
+    if current and before and (current['recording_us']
+                               > before['recording_us'] * (1 + tolerance)):
+        regressions.append('metrics recording: {:.1f} us per request, baseline {:.1f} us'.format(
+            current['recording_us'], before['recording_us']))
+
+    current, before = results.get('cold_start'), baseline.get('cold_start')
+    if current and before and (current['import_ms'] + current['first_response_ms']
+                               > (before['import_ms'] + before['first_response_ms']) * (1 + tolerance)):
+        regressions.append('cold start: {:.0f} ms, baseline {:.0f} ms'.format(
+            current['import_ms'] + current['first_response_ms'],
+            before['import_ms'] + before['first_response_ms']))
+    return regressions
+
+#----------------------------------------------------------------------------#
+# Command line
+#----------------------------------------------------------------------------#
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='1k',
+                        help='actors, movies and performances to seed')
+    parser.add_argument('--actors', type=int, help='overrides --size for actors')
+    parser.add_argument('--movies', type=int, help='overrides --size for movies')
+    parser.add_argument('--performances', type=int, help='overrides --size for performances')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--memory-requests', type=int, default=3,
+                        help='extra requests per route traced for peak memory')
+    parser.add_argument('--bulk-size', type=int, default=100, help='records per bulk request')
+    parser.add_argument('--bulk-rows', type=int, default=10000,
+                        help='rows for the bulk insert throughput run')
+    parser.add_argument('--projection-rows', type=int, default=10000,
+                        help='actors serialized by the ORM against column projection run')
+    parser.add_argument('--concurrency', type=lambda value: [int(level) for level in value.split(',')],
+                        default=[], help='compare the sync worker with asgi.py at these '
+                                         'concurrency levels, e.g. 10,50')
+    parser.add_argument('--db-latency-ms', type=float, default=0,
+                        help='added to every statement during the concurrency comparison '
+                             'and the server load test')
+    parser.add_argument('--server-load', type=lambda value: [
+                            (spec.split(':')[0], int(spec.split(':')[1]) if ':' in spec else 1)
+                            for spec in value.split(',')], default=[],
+                        help='load test gunicorn with these worker classes and worker counts, '
+                             'e.g. sync:4,gthread:1,gevent:1')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='concurrent HTTP clients of the server load test')
+    parser.add_argument('--server-requests', type=int, default=2000,
+                        help='requests per server load test')
+    parser.add_argument('--cold-starts', type=int, default=5,
+                        help='fresh processes timed from import to the first response, 0 skips')
+    parser.add_argument('--metrics-budget-us', type=float, default=50,
+                        help='most microseconds recording the metrics may add to a request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data left by a previous run')
+    parser.add_argument('--output', help='write the results JSON here')
+    parser.add_argument('--baseline', help='compare against this results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression against the baseline')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    size = SIZES[args.size]
+    actors = args.actors or size
+    movies = args.movies or size
+    performances = args.performances or size
+
+    # app.py binds the database when imported
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app
+    from config import bearer_tokens
+    from models import db
+    from seed import seed_database
+
+    app.config['TESTING'] = True
+    missing = missing_scenarios(app)
+    if missing:
+        sys.exit('no benchmark scenario for: ' + ', '.join(missing))
+
+    seed_seconds = None
+    if not args.no_seed:
+        start = time.perf_counter()
+        seed_database(actors, movies, performances, args.seed)
+        seed_seconds = time.perf_counter() - start
+
+    run = Run(actors, movies, args.bulk_size, args.seed)
+    client = app.test_client()
+    headers = {'Authorization': bearer_tokens['executive_producer']}
+    routes = {}
+
+    concurrency = None
+    for phase in ('read', 'write', 'delete'):
+        if phase == 'write' and args.concurrency:
+            from asgi import create_asgi_app
+            concurrency = measure_concurrency(
+                client, create_asgi_app(app), headers, run, args.concurrency,
+                args.requests, args.db_latency_ms / 1000)
+            for name, level in concurrency.items():
+                print('{:<10} {:>8.1f} req/s  p95 {:>8.2f} ms  {:>8,} kB RSS  {:>8.1f} in flight/GB'.format(
+                    name, level['throughput_rps'], level['p95_ms'], level['rss_kb'],
+                    level['in_flight_per_gb']))
+        for scenario in SCENARIOS:
+            if scenario.phase != phase:
+                continue
+            requests = max(1, int(args.requests * scenario.share))
+            name = '{} {}'.format(scenario.method, scenario.rule)
+            routes[name] = run_scenario(client, headers, run, scenario,
+                                        requests, args.memory_requests)
+            print('{:<42} {:>8.1f} req/s  p50 {:>8.2f}  p95 {:>8.2f}  p99 {:>8.2f} ms  {} errors'.format(
+                name, routes[name]['throughput_rps'], routes[name]['p50_ms'],
+                routes[name]['p95_ms'], routes[name]['p99_ms'], routes[name]['errors']))
+
+    with app.app_context():
+        bulk = measure_bulk_insert(args.bulk_rows, args.bulk_size)
+    print('bulk insert {:.0f} rows/s, bulk delete {:.0f} rows/s'.format(
+        bulk['insert_rows_per_second'], bulk['delete_rows_per_second']))
+
+    with app.app_context():
+        projection = measure_projection(args.projection_rows)
+    for name, cost in projection.items():
+        print('{:<16} {:>8.1f} ms CPU  {:>8.0f} kB peak  per 10k rows'.format(
+            name, cost['cpu_ms_per_10k'], cost['peak_memory_kb_per_10k']))
+
+    metrics_overhead = measure_metrics_overhead()
+    print('metrics recording {:.1f} us per request'.format(metrics_overhead['recording_us']))
+
+    servers = []
+    if args.server_load:
+        db.session.remove()
+        paths = []
+        reads = [scenario for scenario in SCENARIOS
+                 if scenario.phase == 'read' and scenario.share == 1]
+        for i in range(args.server_requests):
+            paths.append(reads[i % len(reads)].request(run)[0])
+        for worker_class, workers in args.server_load:
+            servers.append(measure_server(worker_class, workers, args.database_url, paths, headers,
+                                          args.clients, args.db_latency_ms / 1000))
+            print('{:<8} x{:<3} {:>8.1f} req/s  p95 {:>8.2f} ms  {:>8,} kB  {:>8.1f} req/s per GB  {} errors'.format(
+                worker_class, workers, servers[-1]['throughput_rps'], servers[-1]['p95_ms'],
+                servers[-1]['memory_kb'], servers[-1]['rps_per_gb'], servers[-1]['errors']))
+
+    cold_start = None
+    if args.cold_starts:
+        cold_start = measure_cold_start(args.database_url, args.cold_starts)
+        print('cold start: import {:.0f} ms, first response {:.0f} ms, process {:.0f} ms'.format(
+            cold_start['import_ms'], cold_start['first_response_ms'], cold_start['process_ms']))
+
+    results = {
+        'meta': {
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'actors': actors,
+            'movies': movies,
+            'performances': performances,
+            'requests': args.requests,
+            'bulk_size': args.bulk_size,
+            'seed': args.seed,
+            'seed_seconds': seed_seconds,
+            # kilobytes on Linux
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        'routes': routes,
+        'bulk_insert': bulk,
+        'projection': projection,
+        'metrics_overhead': metrics_overhead,
+    }
+    if cold_start:
+        results['cold_start'] = cold_start
+    if concurrency:
+        results['concurrency'] = concurrency
+    if servers:
+        results['servers'] = servers
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    failed = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        failed = bool(regressions)
+
+    if metrics_overhead['recording_us'] > args.metrics_budget_us:
+        print('BUDGET metrics recording: {:.1f} us per request, budget {:.1f} us'.format(
+            metrics_overhead['recording_us'], args.metrics_budget_us))
+        failed = 1
+
+    # timings of failed requests mean nothing: the run fails with or without a baseline
+    for name, route in routes.items():
+        if route['errors']:
+            print('ERRORS {}: {} of {} requests failed'.format(name, route['errors'], route['requests']))
+            failed = 1
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+from datetime import date
+from flask import abort
+from config import bulk_config
+from models import bulk_insert, bulk_update
+
+#----------------------------------------------------------------------------#
+# Bulk request parsing
+#----------------------------------------------------------------------------#
+
+def get_bulk_records(data):
+    '''the request body must be a non-empty JSON array of at most BULK_MAX_RECORDS'''
+    if not isinstance(data, list) or not data:
+        abort(400)
+    if len(data) > bulk_config['BULK_MAX_RECORDS']:
+        abort(413)
+    return data
+
+def get_bulk_ids(data):
+    '''the request body must be {"ids": [...]} with at most BULK_MAX_RECORDS ids'''
+    if not isinstance(data, dict):
+        abort(400)
+    ids = get_bulk_records(data.get('ids'))
+    if not all(type(id) is int for id in ids):
+        abort(400)
+    return set(ids)
+
+def get_batch_size(args):
+    '''?batch_size= sets the rows committed per transaction'''
+    try:
+        batch_size = int(args.get('batch_size', bulk_config['BULK_BATCH_SIZE']))
+    except ValueError:
+        abort(400)
+    if batch_size < 1:
+        abort(400)
+    return batch_size
+
+#----------------------------------------------------------------------------#
+# Record validation
+#----------------------------------------------------------------------------#
+
+def _non_empty_string(field, value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('{} is required'.format(field))
+    return value
+
+def _positive_int(field, value):
+    if type(value) is not int or value < 1:
+        raise ValueError('{} must be a positive integer'.format(field))
+    return value
+
+def _iso_date(field, value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('{} must be an ISO-8601 date'.format(field))
+
+ACTOR_FIELDS = {
+    'name': _non_empty_string,
+    'gender': _non_empty_string,
+    'age': _positive_int,
+}
+
+MOVIE_FIELDS = {
+    'title': _non_empty_string,
+    'release_date': _iso_date,
+}
+
+def _validate(record, fields, partial):
+    if not isinstance(record, dict):
+        return None, 'record must be an object'
+
+    values = {}
+    try:
+        for field, convert in fields.items():
+            if partial and field not in record:
+                continue
+            if field not in record:
+                raise ValueError('{} is required'.format(field))
+            values[field] = convert(field, record[field])
+    except ValueError as e:
+        return None, str(e)
+
+    return values, None
+
+def validate_actor(record):
+    '''returns (column values, None) or (None, error message)'''
+    return _validate(record, ACTOR_FIELDS, partial=False)
+
+def validate_movie(record):
+    '''returns (column values, None) or (None, error message)'''
+    return _validate(record, MOVIE_FIELDS, partial=False)
+
+def validate_actor_patch(record):
+    '''like validate_actor, but every field is optional'''
+    return _validate(record, ACTOR_FIELDS, partial=True)
+
+def validate_movie_patch(record):
+    '''like validate_movie, but every field is optional'''
+    return _validate(record, MOVIE_FIELDS, partial=True)
+
+#----------------------------------------------------------------------------#
+# Bulk operations
+#----------------------------------------------------------------------------#
+
+def bulk_create(model, records, validate, batch_size):
+    '''
+    validates every record, then inserts the valid ones through bulk_insert
+    returns (created ids in request order, per-item errors)
+    '''
+    valid = []
+    errors = []
+    for index, record in enumerate(records):
+        values, error = validate(record)
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            valid.append((index, values))
+
+    ids, failed = bulk_insert(model, valid, batch_size)
+    errors.extend({'index': index, 'message': message}
+                  for index, message in failed.items())
+    errors.sort(key=lambda error: error['index'])
+
+    created = [{'index': index, 'id': ids[index]}
+               for index, _ in valid if index in ids]
+    return created, errors
+
+def bulk_patch(model, records, validate):
+    '''
+    validates every {"id": ..., field: value} record and applies the valid
+    ones through bulk_update in one transaction
+    returns (updated ids, missing ids, per-item errors)
+    '''
+    patches = {}
+    errors = []
+    for index, record in enumerate(records):
+        id = record.get('id') if isinstance(record, dict) else None
+        values, error = validate(record)
+        if type(id) is not int:
+            error = 'id must be an integer'
+        elif not error and not values:
+            error = 'nothing to update'
+        elif not error and id in patches:
+            error = 'duplicate id'
+
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            patches[id] = values
+
+    updated, missing = bulk_update(model, patches)
+    return updated, missing, errors
@@ -0,0 +1,114 @@
+import time
+import zlib
+from flask import request
+from config import compression_config
+from metrics import metrics, timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#----------------------------------------------------------------------------#
+# Response Compression
+#----------------------------------------------------------------------------#
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+def available_encodings():
+    '''content codings this worker can produce, the preferred one first'''
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def new_compressor(encoding, config=compression_config):
+    if encoding == 'br':
+        return brotli.Compressor(quality=config['BROTLI_QUALITY'])
+    return GzipCompressor(config['GZIP_LEVEL'])
+
+def negotiate(accept_encodings):
+    '''the coding to use for the Accept-Encoding header parsed by werkzeug, or None'''
+    for encoding in available_encodings():
+        # quality 0 means "not acceptable"
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def _compressible(response):
+    return (response.status_code >= 200
+            and response.status_code not in (204, 206, 304)
+            and request.method != 'HEAD'
+            and 'Content-Encoding' not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+def compress_response(response, config=compression_config):
+    '''
+    compresses response with the coding the client prefers (brotli, then
+    gzip); bodies under COMPRESSION_MIN_SIZE are left alone, and streamed
+    bodies are compressed chunk by chunk as they are sent
+    bytes and CPU time are recorded per coding in the metrics
+    '''
+    if not config['COMPRESSION'] or not _compressible(response):
+        return response
+
+    # caches must not hand a compressed body to a client that cannot read it
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, new_compressor(encoding, config),
+                                             encoding, response)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < config['COMPRESSION_MIN_SIZE']:
+            return response
+        start = time.perf_counter()
+        with timed('compression'):
+            compressor = new_compressor(encoding, config)
+            compressed = compressor.process(body) + compressor.finish()
+        metrics.record_compression(encoding, len(body), len(compressed),
+                                   time.perf_counter() - start)
+        response.set_data(compressed)
+
+    response.headers['Content-Encoding'] = encoding
+    # the compressed body is another representation of the same version
+    if response.headers.get('ETag'):
+        etag, weak = response.get_etag()
+        response.set_etag(etag, weak=True)
+    return response
+
+def _compress_stream(chunks, compressor, encoding, response):
+    raw = sent = 0
+    seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(response.charset)
+            start = time.perf_counter()
+            compressed = compressor.process(chunk)
+            seconds += time.perf_counter() - start
+            raw += len(chunk)
+            if compressed:
+                sent += len(compressed)
+                yield compressed
+        start = time.perf_counter()
+        compressed = compressor.finish()
+        seconds += time.perf_counter() - start
+        sent += len(compressed)
+        yield compressed
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        metrics.record_compression(encoding, raw, sent, seconds)
@@ -0,0 +1,113 @@
+import json
+import re
+import uuid
+from datetime import date
+from flask import Response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from config import json_config
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#----------------------------------------------------------------------------#
+# JSON Encoding
+#----------------------------------------------------------------------------#
+
+class Fragment:
+    '''
+    JSON that is already encoded, e.g. a cached payload; dumps writes it into
+    the document as-is instead of decoding and encoding it again
+    '''
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json.encode('utf-8') if isinstance(json, str) else json
+
+class StdlibEncoder:
+    '''the json module; always available'''
+    name = 'stdlib'
+
+    def dumps(self, obj, default):
+        return json.dumps(obj, separators=(',', ':'), sort_keys=True,
+                          default=default).encode('utf-8')
+
+class OrjsonEncoder:
+    '''orjson, a C encoder several times faster; dates are ISO 8601 natively'''
+    name = 'orjson'
+
+    def dumps(self, obj, default):
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+ENCODERS = {'stdlib': StdlibEncoder, 'orjson': OrjsonEncoder}
+
+def load_encoder(name):
+    '''the encoder called name; "auto" is orjson when installed, else stdlib'''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in ENCODERS:
+        raise ValueError('unknown JSON_ENCODER {!r}, expected auto or one of {}'.format(
+            name, ', '.join(sorted(ENCODERS))))
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_ENCODER=orjson needs orjson (pip install orjson)')
+    return ENCODERS[name]()
+
+# The process-wide encoder; swap it with use_encoder
+encoder = load_encoder(json_config['JSON_ENCODER'])
+
+def use_encoder(name):
+    global encoder
+    encoder = load_encoder(name)
+    return encoder
+
+def dumps(obj):
+    '''
+    obj as compact JSON bytes with sorted keys, through the current encoder
+    dates are ISO 8601 and Fragments are inserted verbatim
+    '''
+    current = encoder
+    fragments = []
+    marker = None
+
+    def default(value):
+        nonlocal marker
+        if isinstance(value, date):
+            return value.isoformat()
+        if isinstance(value, Fragment):
+            if isinstance(current, OrjsonEncoder) and hasattr(orjson, 'Fragment'):
+                return orjson.Fragment(value.json)
+            # a string no payload can contain, swapped for the fragment below
+            if marker is None:
+                marker = uuid.uuid4().hex
+            fragments.append(value.json)
+            return '{}:{}'.format(marker, len(fragments) - 1)
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+    encoded = current.dumps(obj, default)
+    if fragments:
+        encoded = re.sub(b'"' + marker.encode('ascii') + rb':(\d+)"',
+                         lambda match: fragments[int(match.group(1))], encoded)
+    return encoded
+
+def jsonify(*args, **kwargs):
+    '''
+    flask.jsonify through dumps: the same arguments (one value, several
+    values as a list, or keyword arguments), encoding timed as serialization
+    '''
+    if args and kwargs:
+        raise TypeError('jsonify() takes positional or keyword arguments, not both')
+    data = args[0] if len(args) == 1 else args or kwargs
+
+    with timed('serialization'):
+        body = dumps(data)
+    return Response(body + b'\n', mimetype='application/json')
+
+class JSONEncoder(FlaskJSONEncoder):
+    '''the app's flask.json encoder, with ISO 8601 dates like dumps'''
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
@@ -0,0 +1,38 @@
+from functools import wraps
+from flask import g, request, make_response
+from models import get_versions
+
+#----------------------------------------------------------------------------#
+# Conditional GET
+#----------------------------------------------------------------------------#
+
+def version_etag(tables):
+    '''builds the ETag value from the current version of each table'''
+    versions = get_versions(*tables)
+    return '-'.join('{}.{}'.format(table, versions[table]) for table in tables)
+
+def conditional(*tables):
+    '''
+    tags the response with an ETag built from the versions of tables
+    a matching If-None-Match is answered with 304 before the view runs,
+    so nothing but the version row is read from the database
+    the ETag is kept in g.etag for the decorators below
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = g.etag = version_etag(tables)
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return wrapper
+    return conditional_decorator
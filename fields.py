@@ -0,0 +1,44 @@
+from collections import namedtuple
+from flask import abort
+from models import Actor, Movie, Performance
+
+#----------------------------------------------------------------------------#
+# Sparse fieldsets for the read endpoints
+#----------------------------------------------------------------------------#
+
+# fields accepted by ?fields=, in response order, with the column behind each
+ACTOR_FIELDS = {'id': Actor.id, 'name': Actor.name, 'gender': Actor.gender, 'age': Actor.age}
+MOVIE_FIELDS = {'id': Movie.id, 'title': Movie.title, 'release_date': Movie.release_date}
+# /movies/<id>/actors and /actors/<id>/movies also carry the casting fee
+CAST_FIELDS = dict(ACTOR_FIELDS, actor_fee=Performance.c.actor_fee)
+FILMOGRAPHY_FIELDS = dict(MOVIE_FIELDS, actor_fee=Performance.c.actor_fee)
+
+# names: the fields serialized; columns: what to select, names first
+Fieldset = namedtuple('Fieldset', ['names', 'columns'])
+
+def get_fieldset(args, fields, *required):
+    '''
+    reads ?fields=id,name from the request args, every field is returned
+    without it; a name missing from fields aborts with 400
+    required columns (the id and sort column paginate reads) are selected
+    after the requested ones when they were not asked for
+    returns a Fieldset
+    '''
+    raw = args.get('fields')
+    if raw is None:
+        names = list(fields)
+    else:
+        requested = {name.strip() for name in raw.split(',')}
+        if not requested <= fields.keys():
+            abort(400)
+        names = [name for name in fields if name in requested]
+
+    columns = [fields[name] for name in names]
+    # identity, since == on columns builds SQL expressions
+    columns += [column for column in required
+                if column is not None and not any(column is chosen for chosen in columns)]
+    return Fieldset(names, columns)
+
+def serialize(rows, names):
+    '''the rows of a column query as dicts; the columns past names are left out'''
+    return [dict(zip(names, row)) for row in rows]
@@ -0,0 +1,77 @@
+from datetime import date
+from flask import abort
+from models import Actor, Movie
+
+#----------------------------------------------------------------------------#
+# Query filters for the list endpoints
+#----------------------------------------------------------------------------#
+
+# fields accepted by ?sort=; each one is backed by an index
+ACTOR_SORT_COLUMNS = {'name': Actor.name, 'age': Actor.age}
+MOVIE_SORT_COLUMNS = {'title': Movie.title, 'release_date': Movie.release_date}
+
+def escape_like(value):
+    '''escapes the LIKE wildcards so user input only matches literally'''
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _int_arg(args, name):
+    if name not in args:
+        return None
+    value = args.get(name, type=int)
+    if value is None:
+        abort(400)
+    return value
+
+def _date_arg(args, name):
+    if name not in args:
+        return None
+    try:
+        return date.fromisoformat(args[name])
+    except ValueError:
+        abort(400)
+
+def actor_filters(args):
+    '''
+    ?name= (prefix), ?gender=, ?min_age=, ?max_age=
+    returns the SQL criteria; aborts with 400 on malformed values
+    '''
+    criteria = []
+
+    name = args.get('name')
+    if name:
+        criteria.append(Actor.name.like(escape_like(name) + '%', escape='\\'))
+
+    gender = args.get('gender')
+    if gender:
+        criteria.append(Actor.gender == gender)
+
+    min_age = _int_arg(args, 'min_age')
+    if min_age is not None:
+        criteria.append(Actor.age >= min_age)
+
+    max_age = _int_arg(args, 'max_age')
+    if max_age is not None:
+        criteria.append(Actor.age <= max_age)
+
+    return criteria
+
+def movie_filters(args):
+    '''
+    ?title= (contains, case-insensitive), ?release_date_from=, ?release_date_to=
+    returns the SQL criteria; aborts with 400 on malformed values
+    '''
+    criteria = []
+
+    title = args.get('title')
+    if title:
+        criteria.append(Movie.title.ilike('%' + escape_like(title) + '%', escape='\\'))
+
+    release_date_from = _date_arg(args, 'release_date_from')
+    if release_date_from is not None:
+        criteria.append(Movie.release_date >= release_date_from)
+
+    release_date_to = _date_arg(args, 'release_date_to')
+    if release_date_to is not None:
+        criteria.append(Movie.release_date <= release_date_to)
+
+    return criteria
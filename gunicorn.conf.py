@@ -0,0 +1,56 @@
+'''
+gunicorn settings, read from the working directory by `gunicorn app:app`
+
+The app is imported once in the master and the workers are forked from it,
+so they start without importing anything. create_app makes no database
+round trip, and each worker drops the master's engine after the fork.
+
+GUNICORN_WORKER_CLASS picks how a worker serves concurrent requests:
+    gthread (default)  GUNICORN_THREADS threads, one database connection each
+    gevent             GUNICORN_WORKER_CONNECTIONS greenlets sharing the pool
+    sync               one request at a time per process
+'''
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # before the app is preloaded, so the locks, thread locals and sockets
+    # it creates at import are the cooperative ones in every worker
+    from gevent import monkey
+    monkey.patch_all()
+
+from config import database_config, pool_config
+
+if worker_class == 'gevent' and database_config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+    # psycopg2 is a C extension: unpatched, a query blocks every greenlet of the worker
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        raise RuntimeError('gevent workers on PostgreSQL need psycogreen (pip install psycogreen)')
+    patch_psycopg()
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = os.environ.get('PRELOAD_APP', 'true').lower() in ('1', 'true', 'yes')
+
+# Each worker has its own pool; a thread beyond its capacity would only
+# wait DB_POOL_TIMEOUT for a connection, so that is the default
+pool_capacity = pool_config['DB_POOL_SIZE'] + pool_config['DB_MAX_OVERFLOW']
+# (gunicorn turns sync workers with more than one thread into gthread ones)
+threads = int(os.environ.get('GUNICORN_THREADS', pool_capacity)) if worker_class == 'gthread' else 1
+# waiting greenlets cost little; the ones past the pool queue for a connection
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+
+def on_starting(server):
+    if worker_class == 'gthread' and threads > pool_capacity:
+        server.log.warning('%d threads per worker share %d database connections; '
+                           'raise DB_POOL_SIZE or DB_MAX_OVERFLOW', threads, pool_capacity)
+
+
+def post_fork(server, worker):
+    # a connection opened before the fork would be shared by every worker;
+    # the engine of the app setup_db bound last, for app.py and asgi.py alike
+    from models import dispose_engine
+    dispose_engine()
@@ -1,14 +1,40 @@
+import sys
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from seed import seed_database
 
-migrate = Migrate(app, db)
+# render_as_batch lets autogenerated migrations alter tables on SQLite too
+migrate = Migrate(app, db, render_as_batch=True)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+def print_progress(table, inserted, total):
+    if inserted is None:
+        sys.stderr.write('\nrebuilding {}'.format(table))
+    else:
+        sys.stderr.write('\r{:<12} {:>10,} / {:,} rows'.format(table, inserted, total))
+    sys.stderr.flush()
+
+@manager.option('--actors', type=int, default=1000000)
+@manager.option('--movies', type=int, default=100000)
+@manager.option('--performances', type=int, default=1000000)
+@manager.option('--seed', type=int, default=0, help='same seed, same rows')
+@manager.option('--chunk-size', type=int, default=50000, help='rows per transaction')
+@manager.option('--keep-indexes', action='store_true',
+                help='load with the secondary indexes in place instead of rebuilding them')
+def seed(actors, movies, performances, seed, chunk_size, keep_indexes):
+    '''Drop every table and load synthetic actors, movies and performances'''
+    start = time.perf_counter()
+    seed_database(actors, movies, performances, seed, chunk_size,
+                  drop_indexes=not keep_indexes, progress=print_progress)
+    sys.stderr.write('\nseeded in {:.1f}s\n'.format(time.perf_counter() - start))
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
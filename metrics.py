@@ -0,0 +1,211 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#----------------------------------------------------------------------------#
+# Request Metrics
+#----------------------------------------------------------------------------#
+
+# Upper bounds in seconds; the last bucket (+Inf) is implicit
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('auth', 'db', 'serialization', 'compression')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RequestTimer:
+    '''seconds spent so far in each phase of the current request'''
+    __slots__ = ('start', 'auth', 'db', 'serialization', 'compression')
+
+    def __init__(self, start):
+        self.start = start
+        self.auth = 0.0
+        self.db = 0.0
+        self.serialization = 0.0
+        self.compression = 0.0
+
+class Metrics:
+    '''
+        per (route, method): a histogram of the whole request and one per phase
+        per (route, method, status): a request counter
+        per content coding: bytes before and after compression, and CPU seconds
+        recording is a few dict lookups under one lock, rendering does the rest
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._phases = {}
+        self._statuses = Counter()
+        self._compression = {}
+
+    def record(self, route, method, status, timer, end):
+        key = (route, method)
+        with self._lock:
+            self._statuses[(route, method, status)] += 1
+            histogram = self._durations.get(key)
+            if histogram is None:
+                histogram = self._durations[key] = Histogram()
+                for phase in PHASES:
+                    self._phases[key + (phase,)] = Histogram()
+            histogram.observe(end - timer.start)
+            for phase in PHASES:
+                self._phases[key + (phase,)].observe(getattr(timer, phase))
+
+    def record_compression(self, encoding, raw, sent, seconds):
+        with self._lock:
+            totals = self._compression.setdefault(encoding, [0, 0, 0.0])
+            totals[0] += raw
+            totals[1] += sent
+            totals[2] += seconds
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._phases.clear()
+            self._statuses.clear()
+            self._compression.clear()
+
+    def render(self):
+        '''returns every metric in the Prometheus text exposition format'''
+        with self._lock:
+            durations = [(key, _copy(h)) for key, h in self._durations.items()]
+            phases = [(key, _copy(h)) for key, h in self._phases.items()]
+            statuses = list(self._statuses.items())
+            compression = [(encoding, list(totals)) for encoding, totals in self._compression.items()]
+
+        lines = [
+            '# HELP http_requests_total Requests answered, by route, method and status.',
+            '# TYPE http_requests_total counter',
+        ]
+        for (route, method, status), count in sorted(statuses):
+            lines.append('http_requests_total{{{}}} {}'.format(
+                _labels(route=route, method=method, status=status), count))
+
+        lines += [
+            '# HELP http_request_duration_seconds Time from routing to the response.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (route, method), histogram in sorted(durations):
+            _render_histogram(lines, 'http_request_duration_seconds', histogram,
+                              route=route, method=method)
+
+        lines += [
+            '# HELP http_request_phase_seconds Time spent in auth, database, JSON serialization and compression.',
+            '# TYPE http_request_phase_seconds histogram',
+        ]
+        for (route, method, phase), histogram in sorted(phases):
+            _render_histogram(lines, 'http_request_phase_seconds', histogram,
+                              route=route, method=method, phase=phase)
+
+        lines += [
+            '# HELP http_response_bytes_total Response body bytes before (raw) and after (sent) compression.',
+            '# TYPE http_response_bytes_total counter',
+        ]
+        for encoding, (raw, sent, _) in sorted(compression):
+            lines.append('http_response_bytes_total{{{}}} {}'.format(
+                _labels(encoding=encoding, stage='raw'), raw))
+            lines.append('http_response_bytes_total{{{}}} {}'.format(
+                _labels(encoding=encoding, stage='sent'), sent))
+
+        lines += [
+            '# HELP http_response_compression_seconds_total CPU time spent compressing responses.',
+            '# TYPE http_response_compression_seconds_total counter',
+        ]
+        for encoding, (_, _, seconds) in sorted(compression):
+            lines.append('http_response_compression_seconds_total{{{}}} {!r}'.format(
+                _labels(encoding=encoding), seconds))
+
+        return '\n'.join(lines) + '\n'
+
+def _copy(histogram):
+    copy = Histogram()
+    copy.counts = list(histogram.counts)
+    copy.sum = histogram.sum
+    copy.count = histogram.count
+    return copy
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels.items())
+
+def _render_histogram(lines, name, histogram, **labels):
+    labels = _labels(**labels)
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+    lines.append('{}_sum{{{}}} {!r}'.format(name, labels, histogram.sum))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+
+# Process-wide registry; each worker exposes its own requests
+metrics = Metrics()
+
+#----------------------------------------------------------------------------#
+# Request Timing
+#----------------------------------------------------------------------------#
+
+_local = threading.local()
+
+def start_request():
+    _local.timer = RequestTimer(time.perf_counter())
+
+def finish_request(route, method, status):
+    '''records the current request; a no-op when start_request did not run'''
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return
+    _local.timer = None
+    metrics.record(route, method, status, timer, time.perf_counter())
+
+class timed:
+    '''
+        adds the time spent in the with block to phase of the current request
+            with timed('auth'):
+                ...
+    '''
+    __slots__ = ('phase', 'timer', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.timer = getattr(_local, 'timer', None)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            elapsed = time.perf_counter() - self.start
+            setattr(self.timer, self.phase, getattr(self.timer, self.phase) + elapsed)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.db += elapsed
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(context):
+    # a failed execute never reaches after_cursor_execute
+    if context.cursor is not None and context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
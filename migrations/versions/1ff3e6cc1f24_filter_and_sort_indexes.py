@@ -0,0 +1,34 @@
+"""filter and sort indexes
+
+Revision ID: 1ff3e6cc1f24
+Revises: a8997131e0dd
+Create Date: 2026-10-17 20:34:32.655033
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1ff3e6cc1f24'
+down_revision = 'a8997131e0dd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+    op.create_index('ix_actors_age_id', 'actors', ['age', 'id'])
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'],
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
@@ -0,0 +1,36 @@
+"""table versions
+
+Revision ID: 4b9d2e7a1c30
+Revises: 5c4a5a64cf8f
+Create Date: 2026-10-17 20:32:30.874211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b9d2e7a1c30'
+down_revision = '5c4a5a64cf8f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Per-table write counters behind the ETags and the response cache.
+    # Databases built by an earlier copy of the initial revision have it already.
+    if 'table_versions' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 0} for name in ('actors', 'movies', 'Performance')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,51 @@
+"""initial schema
+
+Revision ID: 5c4a5a64cf8f
+Revises: 
+Create Date: 2026-10-17 20:32:30.598535
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c4a5a64cf8f'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Schema as created by db.create_all() before migrations were introduced.
+    # Databases created that way should run `python manage.py db stamp 5c4a5a64cf8f`
+    # once instead of upgrading through this revision.
+    op.create_table(
+        'actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.Column('age', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release_date', sa.Date(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'Performance',
+        sa.Column('Movie_id', sa.Integer(), nullable=False),
+        sa.Column('Actor_id', sa.Integer(), nullable=False),
+        sa.Column('actor_fee', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['Actor_id'], ['actors.id'], ),
+        sa.ForeignKeyConstraint(['Movie_id'], ['movies.id'], )
+    )
+
+
+def downgrade():
+    op.drop_table('Performance')
+    op.drop_table('movies')
+    op.drop_table('actors')
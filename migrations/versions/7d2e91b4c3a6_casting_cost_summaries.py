@@ -0,0 +1,120 @@
+"""casting cost summaries
+
+Revision ID: 7d2e91b4c3a6
+Revises: 1ff3e6cc1f24
+Create Date: 2026-10-17 21:12:08.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e91b4c3a6'
+down_revision = '1ff3e6cc1f24'
+branch_labels = None
+depends_on = None
+
+# The triggers as this revision created them; later changes to the ones in
+# models.py get their own revision, so this copy must not follow them.
+
+# {key} is the summary table's key column, {row} is NEW or OLD
+ADD_FEE = '''
+    INSERT INTO {table} ("{key}", fee_total, fee_count, cast_count)
+    VALUES ({row}."{key}", COALESCE({row}.actor_fee, 0), {has_fee}, 1)
+    ON CONFLICT ("{key}") DO UPDATE SET
+        fee_total = {table}.fee_total + excluded.fee_total,
+        fee_count = {table}.fee_count + excluded.fee_count,
+        cast_count = {table}.cast_count + 1;
+'''
+REMOVE_FEE = '''
+    UPDATE {table} SET
+        fee_total = fee_total - COALESCE({row}.actor_fee, 0),
+        fee_count = fee_count - {has_fee},
+        cast_count = cast_count - 1
+    WHERE "{key}" = {row}."{key}";
+    DELETE FROM {table} WHERE "{key}" = {row}."{key}" AND cast_count = 0;
+'''
+SUMMARIES = (('movie_costs', 'Movie_id'), ('actor_earnings', 'Actor_id'))
+
+
+def summary_sql(template, row, has_fee):
+    return ''.join(template.format(table=table, key=key, row=row, has_fee=has_fee)
+                   for table, key in SUMMARIES)
+
+
+def summary_triggers(dialect):
+    '''returns (statements creating the triggers, statements dropping them)'''
+    if dialect == 'postgresql':
+        has_fee = '({}.actor_fee IS NOT NULL)::int'
+        creates = [
+            'CREATE OR REPLACE FUNCTION performance_fee_summary() RETURNS trigger AS $$\n'
+            'BEGIN\n'
+            "IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+            + summary_sql(REMOVE_FEE, 'OLD', has_fee.format('OLD')) +
+            'END IF;\n'
+            "IF TG_OP IN ('INSERT', 'UPDATE') THEN"
+            + summary_sql(ADD_FEE, 'NEW', has_fee.format('NEW')) +
+            'END IF;\n'
+            'RETURN NULL;\n'
+            'END;\n'
+            '$$ LANGUAGE plpgsql',
+            'CREATE TRIGGER performance_fee_summary '
+            'AFTER INSERT OR UPDATE OR DELETE ON "Performance" '
+            'FOR EACH ROW EXECUTE PROCEDURE performance_fee_summary()',
+        ]
+        drops = ['DROP TRIGGER IF EXISTS performance_fee_summary ON "Performance"',
+                 'DROP FUNCTION IF EXISTS performance_fee_summary()']
+        return creates, drops
+
+    if dialect == 'sqlite':
+        has_fee = '({}.actor_fee IS NOT NULL)'
+        remove = summary_sql(REMOVE_FEE, 'OLD', has_fee.format('OLD'))
+        add = summary_sql(ADD_FEE, 'NEW', has_fee.format('NEW'))
+        creates = [
+            'CREATE TRIGGER performance_fee_summary_insert AFTER INSERT ON "Performance" '
+            'BEGIN' + add + 'END',
+            'CREATE TRIGGER performance_fee_summary_update AFTER UPDATE ON "Performance" '
+            'BEGIN' + remove + add + 'END',
+            'CREATE TRIGGER performance_fee_summary_delete AFTER DELETE ON "Performance" '
+            'BEGIN' + remove + 'END',
+        ]
+        drops = ['DROP TRIGGER IF EXISTS performance_fee_summary_{}'.format(event)
+                 for event in ('insert', 'update', 'delete')]
+        return creates, drops
+
+    return [], []
+
+
+def upgrade():
+    for table, key in SUMMARIES:
+        op.create_table(
+            table,
+            sa.Column(key, sa.Integer(), nullable=False),
+            sa.Column('fee_total', sa.Float(), nullable=False),
+            sa.Column('fee_count', sa.Integer(), nullable=False),
+            sa.Column('cast_count', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint(key)
+        )
+        op.create_index('ix_{}_fee_total'.format(table), table, ['fee_total'])
+
+        # backfill from the existing castings, the triggers take over from here
+        op.execute(
+            'INSERT INTO {table} ("{key}", fee_total, fee_count, cast_count) '
+            'SELECT "{key}", COALESCE(SUM(actor_fee), 0), COUNT(actor_fee), COUNT(*) '
+            'FROM "Performance" GROUP BY "{key}"'.format(table=table, key=key))
+
+    creates, _ = summary_triggers(op.get_bind().dialect.name)
+    for statement in creates:
+        op.execute(statement)
+
+
+def downgrade():
+    _, drops = summary_triggers(op.get_bind().dialect.name)
+    for statement in drops:
+        op.execute(statement)
+
+    op.drop_index('ix_actor_earnings_fee_total', table_name='actor_earnings')
+    op.drop_table('actor_earnings')
+    op.drop_index('ix_movie_costs_fee_total', table_name='movie_costs')
+    op.drop_table('movie_costs')
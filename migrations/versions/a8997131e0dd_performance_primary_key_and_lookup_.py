@@ -0,0 +1,61 @@
+"""performance primary key and lookup indexes
+
+Revision ID: a8997131e0dd
+Revises: 4b9d2e7a1c30
+Create Date: 2026-10-17 20:32:31.153035
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8997131e0dd'
+down_revision = '4b9d2e7a1c30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep one row per (Movie_id, Actor_id) before the primary key goes on
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute(
+            'DELETE FROM "Performance" a USING "Performance" b '
+            'WHERE a.ctid < b.ctid '
+            'AND a."Movie_id" = b."Movie_id" AND a."Actor_id" = b."Actor_id"'
+        )
+    else:
+        op.execute(
+            'DELETE FROM "Performance" WHERE rowid NOT IN ('
+            'SELECT max(rowid) FROM "Performance" GROUP BY "Movie_id", "Actor_id")'
+        )
+
+    # batch mode rebuilds the table on SQLite, which cannot ALTER a primary key
+    with op.batch_alter_table('Performance') as batch_op:
+        batch_op.create_primary_key('pk_Performance', ['Movie_id', 'Actor_id'])
+
+    # the primary key serves movie -> actors, this one actor -> movies
+    op.create_index('ix_Performance_Actor_id', 'Performance', ['Actor_id', 'Movie_id'])
+    op.create_index('ix_actors_name', 'actors', ['name'],
+                    postgresql_ops={'name': 'text_pattern_ops'})
+    op.create_index('ix_movies_title', 'movies', ['title'])
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_Performance_Actor_id', table_name='Performance')
+
+    # SQLite does not keep constraint names, so give batch mode the named key
+    performance = sa.Table(
+        'Performance', sa.MetaData(),
+        sa.Column('Movie_id', sa.Integer(), sa.ForeignKey('movies.id'), nullable=False),
+        sa.Column('Actor_id', sa.Integer(), sa.ForeignKey('actors.id'), nullable=False),
+        sa.Column('actor_fee', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('Movie_id', 'Actor_id', name='pk_Performance')
+    )
+    with op.batch_alter_table('Performance', copy_from=performance) as batch_op:
+        batch_op.drop_constraint('pk_Performance', type_='primary')
@@ -1,21 +1,40 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine, Date, Float
+from sqlalchemy import Column, String, Integer, create_engine, Date, Float, event, DDL, func
 from flask_sqlalchemy import SQLAlchemy
 import json
+import logging
+from collections import Counter
 from datetime import date
+from itertools import chain
 from config import database_config
+from pool import engine_options
+from replicas import RoutingSQLAlchemy, get_replicas
 
-db = SQLAlchemy()
+# its sessions send the reads of read-only requests to a replica
+db = RoutingSQLAlchemy()
 #----------------------------------------------------------------------------#
 # Database Setup 
 #----------------------------------------------------------------------------#
 def setup_db(app, database_uri=database_config['SQLALCHEMY_DATABASE_URI']):
-    '''binds a flask application and a SQLAlchemy service'''
+    '''binds a flask application and a SQLAlchemy service
+    no connection is made here; migrations create the schema
+    '''
     app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_uri)
+    app.config["SQLALCHEMY_ECHO"] = database_config['SQLALCHEMY_ECHO']
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+def dispose_engine(app=None):
+    '''closes the pooled connections of app's engine
+    a worker forked from a preloaded parent calls it first, so parent and
+    children never share a connection; the read replicas' engines too
+    '''
+    db.get_engine(app).dispose()
+    replicas = get_replicas(db.get_app(app))
+    if replicas is not None:
+        replicas.dispose()
 
 def db_drop_and_create_all():
     '''drops the database tables and starts fresh
@@ -49,8 +68,121 @@ def db_init_records():
     )
   
     db.session.execute(new_performance) 
+    bump_versions(Performance.name)
     db.session.commit()
 
+#----------------------------------------------------------------------------#
+# Bulk Writes
+#----------------------------------------------------------------------------#
+
+def bulk_insert(model, records, batch_size=1000):
+    '''inserts records in transactions of batch_size rows
+
+    records is a list of (index, column values) pairs. On PostgreSQL every
+    batch is a single multi-row INSERT ... RETURNING id; other databases fall
+    back to one statement per row inside the batch transaction.
+    returns (ids, failed): ids maps index to new id, failed maps index to an
+    error message for rows of batches that were rolled back
+    '''
+    table = model.__table__
+    use_returning = db.engine.dialect.name == 'postgresql'
+    ids = {}
+    failed = {}
+
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        try:
+            if use_returning:
+                result = db.session.execute(
+                    table.insert().values([values for _, values in batch])
+                    .returning(table.c.id))
+                new_ids = [row[0] for row in result]
+            else:
+                new_ids = [
+                    db.session.execute(table.insert(), values).inserted_primary_key[0]
+                    for _, values in batch
+                ]
+            bump_versions(table.name)
+            record_changed_rows(table.name, new_ids)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.exception(e)
+            failed.update((index, 'insert failed') for index, _ in batch)
+            continue
+
+        ids.update(zip((index for index, _ in batch), new_ids))
+
+    return ids, failed
+
+def _in_chunks(ids, size=500):
+    '''splits ids so IN lists stay below the bind parameter limits'''
+    ids = sorted(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def existing_ids(model, ids):
+    '''returns the subset of ids present in the model's table'''
+    found = set()
+    for chunk in _in_chunks(ids):
+        found.update(id for id, in db.session.query(model.id).filter(model.id.in_(chunk)))
+    return found
+
+def bulk_update(model, patches):
+    '''applies patches ({id: column values}) with set-based UPDATEs
+
+    ids sharing the same values share one UPDATE ... WHERE id IN (...), all
+    in a single transaction
+    returns (updated ids, missing ids), both sorted
+    '''
+    table = model.__table__
+    found = existing_ids(model, patches)
+
+    groups = {}
+    for id in found:
+        groups.setdefault(tuple(sorted(patches[id].items())), []).append(id)
+
+    try:
+        for values, ids in groups.items():
+            for chunk in _in_chunks(ids):
+                db.session.execute(
+                    table.update().where(table.c.id.in_(chunk)).values(dict(values)))
+        if found:
+            bump_versions(table.name)
+            record_changed_rows(table.name, found)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return sorted(found), sorted(set(patches) - found)
+
+def bulk_delete(model, ids):
+    '''deletes ids and their Performance rows with set-based DELETEs
+
+    nothing is loaded through the Movie.actors relationship; one transaction
+    returns (deleted ids, missing ids), both sorted
+    '''
+    table = model.__table__
+    performance_column = (Performance.c.Actor_id if model is Actor
+                          else Performance.c.Movie_id)
+    found = existing_ids(model, ids)
+
+    try:
+        for chunk in _in_chunks(found):
+            db.session.execute(
+                Performance.delete().where(performance_column.in_(chunk)))
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        if found:
+            bump_versions(table.name, Performance.name)
+            record_changed_rows(table.name, found)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return sorted(found), sorted(set(ids) - found)
+
 #----------------------------------------------------------------------------#
 # Performance Junction Object M:M 
 #----------------------------------------------------------------------------#
@@ -59,17 +191,239 @@ def db_init_records():
 Performance = db.Table(
     'Performance', 
     db.Model.metadata,
-    db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id'),nullable=False),
-    db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id'),nullable=False),
-    db.Column('actor_fee', db.Float)
+    db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id'), nullable=False),
+    db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id'), nullable=False),
+    db.Column('actor_fee', db.Float),
+    # one casting per actor and movie; the key also serves movie -> actors
+    db.PrimaryKeyConstraint('Movie_id', 'Actor_id', name='pk_Performance'),
+    # and this index serves actor -> movies
+    db.Index('ix_Performance_Actor_id', 'Actor_id', 'Movie_id')
+)
+
+#----------------------------------------------------------------------------#
+# Casting Cost Summaries
+#----------------------------------------------------------------------------#
+
+# Running fee totals per movie and per actor, kept up to date by database
+# triggers on Performance so every write path (ORM, bulk, raw SQL) is covered.
+# The top-fees report reads them instead of grouping all of Performance.
+MovieCosts = db.Table(
+    'movie_costs',
+    db.Model.metadata,
+    db.Column('Movie_id', db.Integer, primary_key=True),
+    db.Column('fee_total', db.Float, nullable=False, default=0),
+    db.Column('fee_count', db.Integer, nullable=False, default=0),
+    db.Column('cast_count', db.Integer, nullable=False, default=0),
+    db.Index('ix_movie_costs_fee_total', 'fee_total')
+)
+
+ActorEarnings = db.Table(
+    'actor_earnings',
+    db.Model.metadata,
+    db.Column('Actor_id', db.Integer, primary_key=True),
+    db.Column('fee_total', db.Float, nullable=False, default=0),
+    db.Column('fee_count', db.Integer, nullable=False, default=0),
+    db.Column('cast_count', db.Integer, nullable=False, default=0),
+    db.Index('ix_actor_earnings_fee_total', 'fee_total')
+)
+
+# {key} is the summary table's key column, {row} is NEW or OLD
+_ADD_FEE = '''
+    INSERT INTO {table} ("{key}", fee_total, fee_count, cast_count)
+    VALUES ({row}."{key}", COALESCE({row}.actor_fee, 0), {has_fee}, 1)
+    ON CONFLICT ("{key}") DO UPDATE SET
+        fee_total = {table}.fee_total + excluded.fee_total,
+        fee_count = {table}.fee_count + excluded.fee_count,
+        cast_count = {table}.cast_count + 1;
+'''
+_REMOVE_FEE = '''
+    UPDATE {table} SET
+        fee_total = fee_total - COALESCE({row}.actor_fee, 0),
+        fee_count = fee_count - {has_fee},
+        cast_count = cast_count - 1
+    WHERE "{key}" = {row}."{key}";
+    DELETE FROM {table} WHERE "{key}" = {row}."{key}" AND cast_count = 0;
+'''
+_SUMMARIES = (('movie_costs', 'Movie_id'), ('actor_earnings', 'Actor_id'))
+
+def _summary_sql(template, row, has_fee):
+    return ''.join(template.format(table=table, key=key, row=row, has_fee=has_fee)
+                   for table, key in _SUMMARIES)
+
+def fee_summary_triggers(dialect):
+    '''returns the statements creating the summary triggers on Performance'''
+    if dialect == 'postgresql':
+        has_fee = '({}.actor_fee IS NOT NULL)::int'
+        return [
+            'CREATE OR REPLACE FUNCTION performance_fee_summary() RETURNS trigger AS $$\n'
+            'BEGIN\n'
+            "IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+            + _summary_sql(_REMOVE_FEE, 'OLD', has_fee.format('OLD')) +
+            'END IF;\n'
+            "IF TG_OP IN ('INSERT', 'UPDATE') THEN"
+            + _summary_sql(_ADD_FEE, 'NEW', has_fee.format('NEW')) +
+            'END IF;\n'
+            'RETURN NULL;\n'
+            'END;\n'
+            '$$ LANGUAGE plpgsql',
+            'CREATE TRIGGER performance_fee_summary '
+            'AFTER INSERT OR UPDATE OR DELETE ON "Performance" '
+            'FOR EACH ROW EXECUTE PROCEDURE performance_fee_summary()',
+        ]
+
+    if dialect == 'sqlite':
+        has_fee = '({}.actor_fee IS NOT NULL)'
+        remove = _summary_sql(_REMOVE_FEE, 'OLD', has_fee.format('OLD'))
+        add = _summary_sql(_ADD_FEE, 'NEW', has_fee.format('NEW'))
+        return [
+            'CREATE TRIGGER performance_fee_summary_insert AFTER INSERT ON "Performance" '
+            'BEGIN' + add + 'END',
+            'CREATE TRIGGER performance_fee_summary_update AFTER UPDATE ON "Performance" '
+            'BEGIN' + remove + add + 'END',
+            'CREATE TRIGGER performance_fee_summary_delete AFTER DELETE ON "Performance" '
+            'BEGIN' + remove + 'END',
+        ]
+
+    return []
+
+def fee_summary_trigger_drops(dialect):
+    '''returns the statements removing what fee_summary_triggers creates'''
+    if dialect == 'postgresql':
+        return ['DROP TRIGGER IF EXISTS performance_fee_summary ON "Performance"',
+                'DROP FUNCTION IF EXISTS performance_fee_summary()']
+    if dialect == 'sqlite':
+        return ['DROP TRIGGER IF EXISTS performance_fee_summary_{}'.format(event)
+                for event in ('insert', 'update', 'delete')]
+    return []
+
+def rebuild_fee_summaries(connection):
+    '''recomputes both summary tables from Performance with one GROUP BY each'''
+    for table, key in _SUMMARIES:
+        connection.execute('DELETE FROM {}'.format(table))
+        connection.execute(
+            'INSERT INTO {table} ("{key}", fee_total, fee_count, cast_count) '
+            'SELECT "{key}", COALESCE(SUM(actor_fee), 0), COUNT(actor_fee), COUNT(*) '
+            'FROM "Performance" GROUP BY "{key}"'.format(table=table, key=key))
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_fee_summary_triggers(target, connection, tables=(), **kw):
+    # after every table exists, so the order of create_all does not matter;
+    # tables only lists the ones this create_all actually created
+    if Performance not in tables:
+        return
+    for statement in fee_summary_triggers(connection.dialect.name):
+        connection.execute(statement)
+
+def fee_totals(column, id):
+    '''returns (total, average, fee count, cast count) over the Performance rows
+    where column == id, from a single aggregate query on the indexed key
+    '''
+    return db.session.query(
+        func.coalesce(func.sum(Performance.c.actor_fee), 0),
+        func.avg(Performance.c.actor_fee),
+        func.count(Performance.c.actor_fee),
+        func.count()
+    ).filter(column == id).one()
+
+#----------------------------------------------------------------------------#
+# Table Versions
+#----------------------------------------------------------------------------#
+
+# One monotonically increasing counter per table, bumped in the same
+# transaction as every write, so all workers agree on the current version.
+TableVersions = db.Table(
+    'table_versions',
+    db.Model.metadata,
+    db.Column('name', db.String, primary_key=True),
+    db.Column('version', db.BigInteger, nullable=False, default=0)
 )
 
+VERSIONED_TABLES = ('actors', 'movies', 'Performance')
+
+@event.listens_for(TableVersions, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    connection.execute(target.insert(),
+                       [{'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+#----------------------------------------------------------------------------#
+# Write Notifications
+#----------------------------------------------------------------------------#
+
+# Callables notified after each commit as listener(tables, rows):
+#   tables: Counter of version bumps per table name
+#   rows: {table name: set of ids} inserted, updated or deleted
+write_listeners = []
+
+def register_write_listener(listener):
+    write_listeners.append(listener)
+    return listener
+
+def _pending_writes(session):
+    return session.info.setdefault('pending_writes', (Counter(), {}))
+
+def record_changed_rows(name, ids):
+    '''remembers the rows of table name written by the current transaction'''
+    _pending_writes(db.session)[1].setdefault(name, set()).update(ids)
+
+@event.listens_for(db.session, 'after_flush')
+def record_flushed_rows(session, flush_context):
+    rows = _pending_writes(session)[1]
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (Actor, Movie)):
+            rows.setdefault(instance.__tablename__, set()).add(instance.id)
+
+@event.listens_for(db.session, 'after_commit')
+def notify_write_listeners(session):
+    tables, rows = session.info.pop('pending_writes', (None, None))
+    if not tables:
+        return
+    for listener in write_listeners:
+        try:
+            listener(tables, rows)
+        except Exception as e:
+            logging.exception(e)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_pending_writes(session):
+    session.info.pop('pending_writes', None)
+
+def bump_versions(*names):
+    '''increments the version of each table name inside the current transaction
+    write_listeners are told about the bumps once the transaction commits
+    '''
+    _pending_writes(db.session)[0].update(names)
+    for name in names:
+        result = db.session.execute(
+            TableVersions.update()
+            .where(TableVersions.c.name == name)
+            .values(version=TableVersions.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(TableVersions.insert().values(name=name, version=1))
+
+def get_versions(*names):
+    '''returns {name: version} for names with a single Core SELECT'''
+    rows = db.session.execute(
+        db.select([TableVersions.c.name, TableVersions.c.version])
+        .where(TableVersions.c.name.in_(names)))
+    versions = dict.fromkeys(names, 0)
+    versions.update((name, version) for name, version in rows)
+    return versions
+
 #----------------------------------------------------------------------------#
 # Actors Model 
 #----------------------------------------------------------------------------#
 
 class Actor(db.Model):  
   __tablename__ = 'actors'
+  __table_args__ = (
+    # text_pattern_ops lets PostgreSQL use the index for name LIKE 'prefix%'
+    db.Index('ix_actors_name', 'name', postgresql_ops={'name': 'text_pattern_ops'}),
+    # ?sort=name keyset pages, in the collation order
+    db.Index('ix_actors_name_id', 'name', 'id'),
+    # ?gender= with an age range, and ?min_age= / ?max_age= / ?sort=age alone
+    db.Index('ix_actors_gender_age', 'gender', 'age'),
+    db.Index('ix_actors_age_id', 'age', 'id'),
+  )
 
   id = Column(Integer, primary_key=True)
   name = Column(String)
@@ -83,13 +437,16 @@ class Actor(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_versions(self.__tablename__)
     db.session.commit()
   
   def update(self):
+    bump_versions(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    bump_versions(self.__tablename__, Performance.name)
     db.session.commit()
 
   def format(self):
@@ -104,13 +461,26 @@ class Actor(db.Model):
 # Movies Model 
 #----------------------------------------------------------------------------#
 
+# ix_movies_title_trgm needs the trigram operator classes
+create_pg_trgm = DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+
 class Movie(db.Model):  
   __tablename__ = 'movies'
+  __table_args__ = (
+    db.Index('ix_movies_title', 'title'),
+    db.Index('ix_movies_release_date', 'release_date'),
+    # trigram index for ?title= (ILIKE '%...%'), PostgreSQL only in practice
+    db.Index('ix_movies_title_trgm', 'title', postgresql_using='gin',
+             postgresql_ops={'title': 'gin_trgm_ops'}),
+  )
 
   id = Column(Integer, primary_key=True)
   title = Column(String)
   release_date = Column(Date)
-  actors = db.relationship('Actor', secondary=Performance, backref=db.backref('performances', lazy='joined'))
+  # Lazy on both sides: list views never pay for the join through Performance.
+  # Queries that need the relationship ask for it with selectinload.
+  actors = db.relationship('Actor', secondary=Performance, lazy='select',
+                           backref=db.backref('performances', lazy='select'))
 
   def __init__(self, title, release_date) :
     self.title = title
@@ -118,13 +488,16 @@ class Movie(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_versions(self.__tablename__)
     db.session.commit()
   
   def update(self):
+    bump_versions(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    bump_versions(self.__tablename__, Performance.name)
     db.session.commit()
 
   def format(self):
@@ -133,3 +506,5 @@ class Movie(db.Model):
       'title' : self.title,
       'release_date': self.release_date
     }
+
+event.listen(Movie.__table__, 'before_create', create_pg_trgm)
@@ -0,0 +1,160 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import date
+from flask import abort
+from sqlalchemy import or_, tuple_
+from config import pagination_config
+
+#----------------------------------------------------------------------------#
+# Keyset (cursor) pagination
+#----------------------------------------------------------------------------#
+
+def _cursor_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+def encode_cursor(values):
+    '''turns the sort key of the last row on a page into an opaque cursor'''
+    raw = json.dumps(values, separators=(',', ':'), default=_cursor_default).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''reverses encode_cursor, aborting with 400 on anything it did not produce'''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        abort(400)
+
+    if not isinstance(values, list) or not values:
+        abort(400)
+    return values
+
+def get_page_args(args):
+    '''
+    reads ?limit= and ?after= from the request args
+    returns (limit, cursor values or None); limit is capped at MAX_PAGE_SIZE
+    '''
+    try:
+        limit = int(args.get('limit', pagination_config['DEFAULT_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, pagination_config['MAX_PAGE_SIZE'])
+
+    after = args.get('after')
+    if not after:
+        return limit, None
+
+    # the row id is always the last value of the cursor
+    values = decode_cursor(after)
+    if type(values[-1]) is not int:
+        abort(400)
+    return limit, values
+
+#----------------------------------------------------------------------------#
+# Sorting
+#----------------------------------------------------------------------------#
+
+# name: attribute of the row holding the value; parse: cursor value -> column value
+Sort = namedtuple('Sort', ['name', 'column', 'descending', 'parse'])
+
+def _parse_int(value):
+    if type(value) is not int:
+        raise ValueError(value)
+    return value
+
+def _parse_str(value):
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+SORT_PARSERS = {int: _parse_int, str: _parse_str, date: _parse_date}
+
+def get_sort_args(args, columns, after):
+    '''
+    reads ?sort=<field> or ?sort=-<field> (descending); field must be one
+    of columns ({name: column}); the default is ascending id
+    returns (Sort, after) with the cursor values checked against the sort
+    '''
+    raw = args.get('sort', 'id')
+    descending = raw.startswith('-')
+    name = raw[1:] if descending else raw
+    if name != 'id' and name not in columns:
+        abort(400)
+
+    column = columns.get(name)
+    sort = Sort(name, column, descending,
+                SORT_PARSERS[column.type.python_type] if column is not None else None)
+
+    if after is None:
+        return sort, None
+
+    if column is None:
+        if len(after) != 1:
+            abort(400)
+        return sort, after
+
+    # [sort value, id]; the sort value is null for rows missing it
+    if len(after) != 2:
+        abort(400)
+    try:
+        value = after[0] if after[0] is None else sort.parse(after[0])
+    except (TypeError, ValueError):
+        abort(400)
+    return sort, [value, after[1]]
+
+def _keyset_filter(query, sort, id_column, after):
+    '''
+    rows strictly after the cursor; nulls sort above every value, so they
+    come last ascending and first descending, like PostgreSQL's default
+    '''
+    value, last_id = after
+    column = sort.column
+
+    if sort.descending:
+        if value is None:
+            return query.filter(or_(column.isnot(None),
+                                    (column.is_(None)) & (id_column < last_id)))
+        return query.filter(tuple_(column, id_column) < tuple_(value, last_id))
+
+    if value is None:
+        return query.filter(column.is_(None), id_column > last_id)
+    return query.filter(or_(tuple_(column, id_column) > tuple_(value, last_id),
+                            column.is_(None)))
+
+def paginate(query, id_column, limit, after, sort=None):
+    '''
+    runs query as one keyset page ordered by sort (then id_column)
+    fetches limit + 1 rows so the next cursor needs no COUNT query
+    returns (rows, next_cursor or None)
+    '''
+    descending = sort is not None and sort.descending
+
+    if sort is None or sort.column is None:
+        if after is not None:
+            query = query.filter(id_column < after[-1] if descending else id_column > after[-1])
+        ordering = [id_column.desc() if descending else id_column]
+    else:
+        if after is not None:
+            query = _keyset_filter(query, sort, id_column, after)
+        if descending:
+            ordering = [sort.column.desc().nullsfirst(), id_column.desc()]
+        else:
+            ordering = [sort.column.asc().nullslast(), id_column]
+
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    if sort is None or sort.column is None:
+        return rows, encode_cursor([last.id])
+    return rows, encode_cursor([getattr(last, sort.name), last.id])
@@ -0,0 +1,120 @@
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+from config import pool_config
+
+#----------------------------------------------------------------------------#
+# Connection Pool
+#----------------------------------------------------------------------------#
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that also records how long checkouts wait for a connection
+    and how many give up after pool_timeout seconds
+    '''
+    def __init__(self, *args, max_overflow=10, **kw):
+        super().__init__(*args, max_overflow=max_overflow, **kw)
+        # as configured; QueuePool keeps no public accessor for it
+        self.max_overflow = max_overflow
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+def engine_options(database_uri, config=pool_config):
+    '''
+    returns the SQLALCHEMY_ENGINE_OPTIONS for database_uri
+    in-memory SQLite keeps the single shared connection Flask-SQLAlchemy gives it
+    '''
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+    if backend in ('postgres', 'postgresql') and config['DB_STATEMENT_TIMEOUT']:
+        # applied by the server to every statement of the connection
+        options['connect_args'] = {
+            'options': '-c statement_timeout={:d}'.format(config['DB_STATEMENT_TIMEOUT'])}
+    elif backend == 'sqlite':
+        # pooled connections move between the threads of a worker
+        options['connect_args'] = {'check_same_thread': False}
+
+    return options
+
+def pool_stats(engine):
+    '''returns the live state of the engine's connection pool as a dict'''
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            # negative until the pool has opened pool_size connections
+            'overflow': pool.overflow(),
+            'timeout': pool.timeout(),
+        })
+
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'max_overflow': pool.max_overflow,
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_seconds_total': pool.wait_total,
+                'wait_seconds_max': pool.wait_max,
+                'wait_seconds_avg': pool.wait_total / pool.checkouts if pool.checkouts else 0.0,
+            })
+
+    return stats
+
+def warm_pool(engine, connections=None):
+    '''
+    opens up to connections pooled connections at once (by default the pool
+    size less the ones in use) and runs a round trip on each, so the first
+    requests find them ready; raises when the database is unreachable
+    returns the number of connections checked
+    '''
+    pool = engine.pool
+    if connections is None:
+        connections = (max(1, pool.size() - pool.checkedout())
+                       if isinstance(pool, QueuePool) else 1)
+
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.connect())
+            opened[-1].execute(text('SELECT 1'))
+    finally:
+        for connection in opened:
+            connection.close()
+    return len(opened)
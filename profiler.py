@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import profiler_config
+
+#----------------------------------------------------------------------------#
+# SQL Query Profiler
+#----------------------------------------------------------------------------#
+
+# Slow statements and N+1 suspects, kept out of api.log (which only takes errors)
+slow_query_log = logging.getLogger('slow_queries')
+
+class QueryProfile:
+    '''the statements one request sent to the database'''
+    __slots__ = ('route', 'count', 'seconds', 'statements')
+
+    def __init__(self, route):
+        self.route = route
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def repeated(self, threshold):
+        '''returns [(statement, times)] run at least threshold times, the N+1 suspects'''
+        return [(statement, times) for statement, times in self.statements.most_common()
+                if times >= threshold]
+
+    def server_timing(self):
+        return 'db;dur={:.3f};desc="{} queries"'.format(self.seconds * 1000, self.count)
+
+_local = threading.local()
+enabled = False
+
+def start_profile(route):
+    if enabled:
+        _local.profile = QueryProfile(route)
+
+def finish_profile():
+    '''returns the QueryProfile of the current request, or None when profiling is off
+    logs the statements repeated N_PLUS_ONE_THRESHOLD times or more
+    '''
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return None
+    _local.profile = None
+
+    for statement, times in profile.repeated(profiler_config['N_PLUS_ONE_THRESHOLD']):
+        slow_query_log.warning('possible N+1 on %s: %d x %s', profile.route, times, statement)
+    return profile
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['profile_start'].pop()
+    profile = getattr(_local, 'profile', None)
+
+    if profile is not None:
+        profile.count += 1
+        profile.seconds += elapsed
+        profile.statements[statement] += 1
+
+    if elapsed >= profiler_config['SLOW_QUERY_SECONDS']:
+        # parameters are left out, they may carry personal data
+        slow_query_log.warning('slow query on %s: %.1f ms %s',
+                               profile.route if profile else 'no request',
+                               elapsed * 1000, statement)
+
+def _handle_error(context):
+    if context.cursor is not None and context.connection is not None:
+        starts = context.connection.info.get('profile_start')
+        if starts:
+            starts.pop()
+
+def enable_profiler():
+    '''attaches the profiler to every engine; costs nothing until called'''
+    global enabled
+    if enabled:
+        return
+    if profiler_config['SLOW_QUERY_LOG'] and not slow_query_log.handlers:
+        slow_query_log.addHandler(logging.FileHandler(profiler_config['SLOW_QUERY_LOG']))
+        slow_query_log.setLevel(logging.WARNING)
+        slow_query_log.propagate = False
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    enabled = True
+
+def disable_profiler():
+    global enabled
+    if not enabled:
+        return
+    event.remove(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.remove(Engine, 'handle_error', _handle_error)
+    _local.profile = None
+    enabled = False
@@ -0,0 +1,228 @@
+import itertools
+import logging
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+import zlib
+from flask import _request_ctx_stack, current_app, g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from config import replica_config
+from pool import engine_options
+
+#----------------------------------------------------------------------------#
+# Read Replicas
+#----------------------------------------------------------------------------#
+
+# methods that never write; the others are routed to the primary
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+class Replica:
+    '''
+    a read-only copy of the primary database with its own engine; it is
+    taken out of the rotation when a check or a query cannot reach it
+    '''
+    def __init__(self, uri):
+        self.uri = uri
+        self.engine = create_engine(uri, **engine_options(uri))
+        self.healthy = True
+        self.checked_at = None
+        self.failures = 0
+        self._checking = threading.Lock()
+        event.listen(self.engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        # a query that lost its connection; later requests skip the replica
+        if context.is_disconnect:
+            self.mark_down()
+
+    def mark_down(self):
+        self.healthy = False
+        self.failures += 1
+        self.checked_at = time.monotonic()
+
+    def check(self):
+        '''one SELECT 1 round trip; returns whether the replica answered'''
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception as e:
+            logging.warning('read replica %r is unavailable: %s', self.engine.url, e)
+            self.mark_down()
+        else:
+            self.healthy = True
+            self.checked_at = time.monotonic()
+        return self.healthy
+
+    def stats(self):
+        # no URL: it names the host, user and database
+        return {'healthy': self.healthy, 'failures': self.failures}
+
+class ReplicaSet:
+    '''
+        @INPUTS
+            uris: SQLAlchemy URIs of the replicas (a list)
+            check_interval: seconds a healthy replica is trusted before it is checked again
+            retry_interval: seconds before a failed replica is checked again
+
+        Hands out the replicas in turn. A replica is checked with a round trip
+        when it is picked after its interval ran out, so a worker spends at
+        most one check per replica and interval; down replicas are skipped.
+    '''
+    def __init__(self, uris, check_interval=replica_config['REPLICA_CHECK_INTERVAL'],
+                 retry_interval=replica_config['REPLICA_RETRY_INTERVAL']):
+        self.replicas = [Replica(uri) for uri in uris]
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self._turn = itertools.count()
+
+    def _due(self, replica, now):
+        if replica.checked_at is None:
+            return True
+        interval = self.check_interval if replica.healthy else self.retry_interval
+        return now - replica.checked_at >= interval
+
+    def choose(self):
+        '''the engine of the next healthy replica, or None to use the primary'''
+        if not self.replicas:
+            return None
+        # itertools.count is atomic, so threads never take the same turn twice
+        start = next(self._turn)
+        now = time.monotonic()
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            # one thread checks a due replica, the others go by its last result
+            if self._due(replica, now) and replica._checking.acquire(blocking=False):
+                try:
+                    replica.check()
+                finally:
+                    replica._checking.release()
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def stats(self):
+        '''one entry per replica, numbered in the order of DATABASE_REPLICA_URLS'''
+        return [dict(replica.stats(), index=index)
+                for index, replica in enumerate(self.replicas)]
+
+class WriterPins:
+    '''
+        @INPUTS
+            seconds: how long a client reads from the primary after a write
+            slots: size of the table
+
+        The token subjects that wrote recently, as the time their window ends.
+        The table is shared memory, so worker processes forked after it is
+        made (gunicorn preload_app) see each other's writes. A subject hashes
+        to one slot; two subjects sharing a slot only cost primary reads.
+    '''
+    def __init__(self, seconds=replica_config['READ_YOUR_WRITES_SECONDS'],
+                 slots=replica_config['READ_YOUR_WRITES_SLOTS']):
+        self.seconds = seconds
+        # time.monotonic is one clock for every process of the machine
+        self._until = multiprocessing.Array('d', slots)
+
+    def _slot(self, subject):
+        return zlib.crc32(subject.encode('utf-8')) % len(self._until)
+
+    def pin(self, subject):
+        slot = self._slot(subject)
+        with self._until.get_lock():
+            self._until[slot] = max(self._until[slot], time.monotonic() + self.seconds)
+
+    def pinned(self, subject):
+        return self._until[self._slot(subject)] > time.monotonic()
+
+def setup_replicas(app, uris=replica_config['SQLALCHEMY_REPLICA_URIS']):
+    '''binds the read replicas at uris to app; no connection is made here'''
+    app.extensions['replicas'] = ReplicaSet(uris)
+    if uris and replica_config['READ_YOUR_WRITES_SECONDS'] > 0:
+        app.extensions['replica_pins'] = WriterPins()
+    return app.extensions['replicas']
+
+def get_replicas(app=None):
+    return (app or current_app).extensions.get('replicas')
+
+#----------------------------------------------------------------------------#
+# Request Routing
+#----------------------------------------------------------------------------#
+
+def token_subject():
+    '''the sub claim of the token requires_auth verified for this request, or None'''
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    return payload.get('sub') if payload else None
+
+def route_request():
+    '''
+    forgets the replica of a previous request sharing the app context; the
+    next one is picked on the first query, once the token is verified
+    '''
+    g.pop('replica', None)
+
+def request_replica():
+    '''
+    the replica engine for the queries of a read-only request, or None for
+    the primary: when its client wrote recently, or no replica is healthy
+    '''
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+    if g.get('use_primary'):
+        return None
+    if 'replica' not in g:
+        replicas = get_replicas()
+        pins = current_app.extensions.get('replica_pins')
+        subject = token_subject()
+        pinned = pins is not None and subject is not None and pins.pinned(subject)
+        g.replica = replicas.choose() if replicas and not pinned else None
+    return g.replica
+
+@contextmanager
+def use_primary():
+    '''
+    sends the queries made inside the block to the primary, for readers that
+    must see every committed row, such as state kept in sync with the tables
+    '''
+    if not has_app_context():
+        yield
+        return
+    previous = g.get('use_primary', False)
+    g.use_primary = True
+    try:
+        yield
+    finally:
+        g.use_primary = previous
+
+def pin_after_write(response):
+    '''
+    after a successful write, reads with the same token subject go to the
+    primary for READ_YOUR_WRITES_SECONDS, while the replicas catch up
+    '''
+    pins = current_app.extensions.get('replica_pins')
+    subject = token_subject()
+    if (pins is not None and subject is not None and request.method not in READ_METHODS
+            and response.status_code < 400):
+        pins.pin(subject)
+    return response
+
+class RoutingSession(SignallingSession):
+    '''
+    the session of db: reads of a read-only request go to the replica
+    request_replica picks; flushes, and everything outside a request, use
+    the primary
+    '''
+    def get_bind(self, mapper=None, clause=None):
+        replica = None if self._flushing else request_replica()
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy whose sessions are RoutingSessions'''
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, make_response, Response
+from config import cache_config
+from models import register_write_listener
+from etag import version_etag
+
+#----------------------------------------------------------------------------#
+# Response Cache
+#----------------------------------------------------------------------------#
+
+class ResponseCache:
+    '''
+    bounded TTL + LRU cache of serialized responses, safe to share between threads
+
+    every entry records the tables it was built from; invalidate(tables)
+    drops exactly the entries that read one of them
+    '''
+    def __init__(self, maxsize=256, ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, tables, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self._clock() + self.ttl, value, tables)
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                for key in self._keys_by_table.pop(table, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_table.clear()
+
+    def _remove(self, key):
+        _, _, tables = self._entries.pop(key)
+        for table in tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+response_cache = ResponseCache(cache_config['RESPONSE_CACHE_SIZE'],
+                               cache_config['RESPONSE_CACHE_TTL'])
+
+# drop cached responses as soon as a commit writes one of their tables
+@register_write_listener
+def invalidate_response_cache(tables, rows):
+    response_cache.invalidate(tables)
+
+def cached(*tables):
+    '''
+    serves the view from response_cache
+
+    the key holds the path, the query parameters, the caller's permissions
+    and the table versions (the ETag set by conditional), so a worker that
+    missed another worker's commit can never serve the old version
+    '''
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            etag = g.get('etag') or version_etag(tables)
+            key = (
+                request.path,
+                tuple(sorted(request.args.items(multi=True))),
+                frozenset(payload.get('permissions') or ()),
+                etag,
+            )
+
+            entry = response_cache.get(key)
+            if entry is not None:
+                body, status, mimetype = entry
+                return Response(body, status=status, mimetype=mimetype)
+
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.put(key, tables,
+                                   (response.get_data(), 200, response.mimetype))
+            return response
+
+        return wrapper
+    return cached_decorator
@@ -0,0 +1,415 @@
+import bisect
+import heapq
+import logging
+import re
+import sys
+import threading
+import time
+from flask import current_app
+from config import search_config
+from models import db, get_versions, register_write_listener, Actor, Movie
+from replicas import use_primary
+
+#----------------------------------------------------------------------------#
+# Inverted Index
+#----------------------------------------------------------------------------#
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# sorts after any token that starts with a given prefix
+PREFIX_END = '\U0010ffff'
+
+EMPTY = frozenset()
+
+# terms matching more documents keep their matches ranked between writes
+RANKED_MIN_DOCUMENTS = 256
+# ranked terms kept at once, the least recently built dropped first
+RANKED_TERMS = 256
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+class InvertedIndex:
+    '''
+    token -> documents postings plus a sorted vocabulary for prefix lookups
+
+    documents are keyed by (kind, id); every method is thread safe
+    the matches of dense terms (short prefixes, common names) are kept
+    sorted by text length, so a search reads them best first and stops once
+    no later document can rank higher; a write drops the terms it touches
+    '''
+    def __init__(self, min_prefix=3):
+        self.min_prefix = min_prefix
+        self._lock = threading.RLock()
+        self._documents = {}
+        self._postings = {}
+        self._vocabulary = []
+        # first token of each document -> count, for the leading-phrase bonus
+        self._leading = {}
+        self._leading_vocabulary = []
+        # term -> (documents matched, ranked list of them)
+        self._ranked = {}
+
+    def add(self, kind, id, text):
+        '''indexes text for (kind, id), replacing what was indexed before'''
+        key = (kind, id)
+        with self._lock:
+            self._remove(key)
+            tokens = tokenize(text)
+            if not tokens:
+                return
+
+            self._documents[key] = (text, frozenset(tokens), tokens[0])
+            self._add_leading(tokens[0])
+            for token in self._documents[key][1]:
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = set()
+                    bisect.insort(self._vocabulary, token)
+                postings.add(key)
+                self._forget_ranked(token)
+
+    def load(self, documents):
+        '''bulk-adds (kind, id, text) documents, sorting the vocabulary once'''
+        with self._lock:
+            for kind, id, text in documents:
+                key = (kind, id)
+                self._remove(key)
+                tokens = tokenize(text)
+                if not tokens:
+                    continue
+                self._documents[key] = (text, frozenset(tokens), tokens[0])
+                self._leading[tokens[0]] = self._leading.get(tokens[0], 0) + 1
+                for token in self._documents[key][1]:
+                    self._postings.setdefault(token, set()).add(key)
+            self._vocabulary = sorted(self._postings)
+            self._leading_vocabulary = sorted(self._leading)
+            self._ranked.clear()
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove((kind, id))
+
+    def _remove(self, key):
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        self._remove_leading(document[2])
+        for token in document[1]:
+            postings = self._postings[token]
+            postings.discard(key)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+            self._forget_ranked(token)
+
+    def _add_leading(self, token):
+        count = self._leading.get(token, 0)
+        if not count:
+            bisect.insort(self._leading_vocabulary, token)
+        self._leading[token] = count + 1
+
+    def _remove_leading(self, token):
+        count = self._leading.pop(token) - 1
+        if count:
+            self._leading[token] = count
+        else:
+            del self._leading_vocabulary[bisect.bisect_left(self._leading_vocabulary, token)]
+
+    def _forget_ranked(self, token):
+        # the terms whose matches include token: the token and its prefixes
+        if self._ranked:
+            self._ranked.pop(token, None)
+            for end in range(self.min_prefix, len(token)):
+                self._ranked.pop(token[:end], None)
+
+    @staticmethod
+    def _starts_with(vocabulary, prefix):
+        start = bisect.bisect_left(vocabulary, prefix)
+        return start < len(vocabulary) and vocabulary[start].startswith(prefix)
+
+    def _expand(self, prefix):
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + PREFIX_END, start)
+        return self._vocabulary[start:end]
+
+    def _rank_key(self, key):
+        return len(self._documents[key][0]), key
+
+    def _matches(self, term):
+        '''
+        (documents term matches, the same ranked by text length or None);
+        terms shorter than min_prefix match whole tokens only
+        '''
+        cached = self._ranked.get(term)
+        if cached is not None:
+            return cached
+
+        if len(term) >= self.min_prefix:
+            tokens = self._expand(term)
+            matched = (self._postings[tokens[0]] if len(tokens) == 1
+                       else set().union(*(self._postings[token] for token in tokens)))
+        else:
+            matched = self._postings.get(term, EMPTY)
+        if len(matched) < RANKED_MIN_DOCUMENTS:
+            return matched, None
+
+        # a copy: the postings change in place on writes, the cache is dropped
+        cached = self._ranked[term] = (frozenset(matched), sorted(matched, key=self._rank_key))
+        if len(self._ranked) > RANKED_TERMS:
+            del self._ranked[next(iter(self._ranked))]
+        return cached
+
+    def search(self, query, limit, kinds=None):
+        '''
+        every query term must match a token of the document, exactly or as a
+        prefix (terms shorter than min_prefix only match whole tokens); exact
+        matches rank above prefix matches, then documents whose text starts
+        with the query, then shorter texts
+        returns up to limit (kind, id, text) tuples, best first
+        '''
+        terms = tokenize(query)
+        if not terms:
+            return []
+        phrase = ' '.join(terms)
+
+        with self._lock:
+            matches = []
+            for term in terms:
+                matched, ordered = self._matches(term)
+                if not matched:
+                    return []
+                matches.append((self._postings.get(term, EMPTY), matched, ordered))
+
+            # intersect from the rarest term up, then walk the documents best first
+            matches.sort(key=lambda match: len(match[1]))
+            _, candidates, ordered = matches[0]
+            if len(matches) > 1:
+                candidates = candidates.intersection(*(matched for _, matched, _ in matches[1:]))
+                if ordered is not None and len(candidates) >= RANKED_MIN_DOCUMENTS:
+                    # lazily, the walk below usually stops early
+                    ordered = (key for key in ordered if key in candidates)
+                else:
+                    ordered = None
+            if ordered is None:
+                ordered = sorted(candidates, key=self._rank_key)
+
+            # the best score a document can still reach; once limit documents
+            # reach it, the longer texts that follow cannot outrank them
+            best = sum(2 if exact else 1 for exact, _, _ in matches)
+            if self._starts_with(self._leading_vocabulary, terms[0]):
+                best += 1
+
+            ranked = []
+            reached = 0
+            for key in ordered:
+                if kinds is not None and key[0] not in kinds:
+                    continue
+                text = self._documents[key][0]
+                score = sum(2 if key in exact else 1 for exact, _, _ in matches)
+                if text.lower().startswith(phrase):
+                    score += 1
+                ranked.append((-score, len(text), key, text))
+                reached += score == best
+                if reached == limit:
+                    break
+
+        return [(kind, id, text)
+                for _, _, (kind, id), text in heapq.nsmallest(limit, ranked)]
+
+    def stats(self):
+        '''sizes plus an estimate of the memory held, in bytes'''
+        with self._lock:
+            memory = (sys.getsizeof(self._documents) + sys.getsizeof(self._postings)
+                      + sys.getsizeof(self._vocabulary))
+            for key, (text, tokens, leading) in self._documents.items():
+                memory += sys.getsizeof(key) + sys.getsizeof(text) + sys.getsizeof(tokens)
+            for token, postings in self._postings.items():
+                memory += sys.getsizeof(token) + sys.getsizeof(postings)
+            for matched, ordered in self._ranked.values():
+                memory += sys.getsizeof(matched) + sys.getsizeof(ordered)
+            return {
+                'documents': len(self._documents),
+                'tokens': len(self._vocabulary),
+                'postings': sum(len(postings) for postings in self._postings.values()),
+                'ranked_terms': len(self._ranked),
+                'memory_bytes': memory,
+            }
+
+#----------------------------------------------------------------------------#
+# Search Index over Actor and Movie
+#----------------------------------------------------------------------------#
+
+# kind -> (model, indexed column)
+SEARCHABLE = {
+    'actor': (Actor, Actor.name),
+    'movie': (Movie, Movie.title),
+}
+TABLE_KINDS = {'actors': 'actor', 'movies': 'movie'}
+
+class SearchIndex:
+    '''
+    builds the InvertedIndex from the database on first use, then keeps it
+    current from the write notifications of models.py: rows written by this
+    process are re-read by id before the next search. Writes made by other
+    processes show up as table versions this process did not account for,
+    checked at most every check_interval seconds; a new index is then built
+    on a background thread while searches keep using the current one, and
+    swapped in when it is complete.
+    '''
+    def __init__(self, check_interval=5, min_prefix=3, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.min_prefix = min_prefix
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self.index = None
+        self._expected_versions = None
+        self._stale = {kind: set() for kind in SEARCHABLE}
+        self._checked_at = None
+        # the background rebuild, and the rows applied to the index it replaces
+        self._rebuild = None
+        self._replay = None
+        self.builds = 0
+
+    def on_write(self, tables, rows):
+        with self._pending_lock:
+            if self._expected_versions is None:
+                return
+            for table, bumps in tables.items():
+                if table in self._expected_versions:
+                    self._expected_versions[table] += bumps
+            for table, ids in rows.items():
+                kind = TABLE_KINDS.get(table)
+                if kind is not None:
+                    self._stale[kind].update(ids)
+
+    def search(self, query, limit, kinds=None):
+        self.ensure_current()
+        return self.index.search(query, limit, kinds)
+
+    def ensure_current(self):
+        # a lagging replica would hide rows this process was told about, and
+        # once it catches up the versions match, so nothing rebuilds them
+        with self._lock, use_primary():
+            if self.index is None:
+                # nothing to answer from yet: the first build runs in the request
+                self._install(*self._build())
+                return
+
+            now = self._clock()
+            if self._rebuild is None and now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                with self._pending_lock:
+                    expected = dict(self._expected_versions)
+                if get_versions(*TABLE_KINDS) != expected:
+                    self._start_rebuild()
+
+            self._apply_stale()
+
+    def _build(self):
+        '''returns a new index, the versions it reflects and this process's expected ones'''
+        # read the versions first: a write landing mid-build only causes
+        # one more rebuild later, never a missed update
+        versions = get_versions(*TABLE_KINDS)
+        with self._pending_lock:
+            expected = dict(self._expected_versions) if self._expected_versions else None
+        index = InvertedIndex(self.min_prefix)
+        for kind, (model, column) in SEARCHABLE.items():
+            rows = db.session.query(model.id, column).yield_per(5000)
+            index.load((kind, id, text) for id, text in rows)
+        return index, versions, expected
+
+    def _install(self, index, versions, expected):
+        # called with self._lock held
+        with self._pending_lock:
+            if expected is not None and self._expected_versions is not None:
+                # bumps this process made while the index was being built
+                for table in versions:
+                    versions[table] += self._expected_versions[table] - expected[table]
+            self._expected_versions = versions
+            if self._replay is None:
+                for ids in self._stale.values():
+                    ids.clear()
+            else:
+                # rows written during the build may be missing from it
+                for kind, ids in self._replay.items():
+                    self._stale[kind].update(ids)
+                self._replay = None
+        self.index = index
+        self._checked_at = self._clock()
+        self.builds += 1
+
+    def _start_rebuild(self):
+        # called with self._lock held
+        app = current_app._get_current_object()
+        with self._pending_lock:
+            self._replay = {kind: set() for kind in SEARCHABLE}
+        self._rebuild = threading.Thread(target=self._run_rebuild, args=(app,),
+                                         name='search-index-rebuild', daemon=True)
+        self._rebuild.start()
+
+    def _run_rebuild(self, app):
+        built = None
+        try:
+            with app.app_context(), use_primary():
+                try:
+                    built = self._build()
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            logging.exception(e)
+        with self._lock:
+            if built is not None and self.index is not None:
+                self._install(*built)
+            else:
+                with self._pending_lock:
+                    self._replay = None
+            self._rebuild = None
+
+    def wait(self, timeout=None):
+        '''blocks until the background rebuild in progress, if any, is installed'''
+        rebuild = self._rebuild
+        if rebuild is not None:
+            rebuild.join(timeout)
+
+    def _apply_stale(self):
+        with self._pending_lock:
+            stale = {kind: ids for kind, ids in self._stale.items() if ids}
+            self._stale = {kind: set() for kind in SEARCHABLE}
+            if self._replay is not None:
+                for kind, ids in stale.items():
+                    self._replay[kind].update(ids)
+
+        for kind, ids in stale.items():
+            model, column = SEARCHABLE[kind]
+            ids = sorted(ids)
+            texts = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = db.session.query(model.id, column).filter(model.id.in_(chunk))
+                texts.update((id, text) for id, text in rows)
+            for id in ids:
+                if id in texts:
+                    self.index.add(kind, id, texts[id])
+                else:
+                    self.index.remove(kind, id)
+
+    def reset(self):
+        '''drops the index; the next search builds it again'''
+        self.wait()
+        with self._lock:
+            self.index = None
+            with self._pending_lock:
+                self._expected_versions = None
+
+    def stats(self):
+        stats = self.index.stats() if self.index is not None else {}
+        stats['builds'] = self.builds
+        stats['rebuilding'] = self._rebuild is not None
+        return stats
+
+
+search_index = SearchIndex(search_config['SEARCH_CHECK_INTERVAL'],
+                           search_config['SEARCH_MIN_PREFIX'])
+register_write_listener(search_index.on_write)
@@ -0,0 +1,177 @@
+import csv
+import io
+import random
+from datetime import date, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+from models import (db, bump_versions, get_versions, fee_summary_triggers, fee_summary_trigger_drops,
+                    rebuild_fee_summaries, Actor, Movie, Performance, MovieCosts,
+                    ActorEarnings, TableVersions, VERSIONED_TABLES)
+
+#----------------------------------------------------------------------------#
+# Synthetic Data
+#----------------------------------------------------------------------------#
+
+FIRST_NAMES = (
+    'Ada', 'Ben', 'Clara', 'David', 'Elena', 'Felix', 'Grace', 'Hugo', 'Iris', 'Jack',
+    'Kara', 'Liam', 'Maya', 'Noah', 'Olga', 'Paul', 'Quinn', 'Rosa', 'Sam', 'Tara',
+    'Umar', 'Vera', 'Will', 'Xena', 'Yuri', 'Zoe',
+)
+LAST_NAMES = (
+    'Adams', 'Brooks', 'Chen', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Ito',
+    'Jones', 'Khan', 'Lopez', 'Martin', 'Nakamura', 'Okafor', 'Patel', 'Rossi', 'Silva',
+    'Taylor', 'Usman', 'Varga', 'Weber', 'Young', 'Zhang',
+)
+TITLE_WORDS = (
+    'Dark', 'Silent', 'Last', 'Broken', 'Golden', 'Hidden', 'Midnight', 'Wild', 'Red',
+    'Frozen', 'River', 'City', 'Storm', 'Garden', 'Empire', 'Echo', 'Harbor', 'Shadow',
+    'Summer', 'Machine', 'Kingdom', 'Signal', 'Orchard', 'Voyage',
+)
+GENDERS = ('Female', 'Male')
+FEES = (None, 500.0, 1000.0, 2500.0, 5000.0, 10000.0, 25000.0, 100000.0)
+FIRST_RELEASE = date(1950, 1, 1)
+
+# Rows are generated as tuples in these column orders; rng.random() indexing
+# is several times cheaper than choice()/randint() at millions of rows
+ACTOR_COLUMNS = ('name', 'gender', 'age')
+MOVIE_COLUMNS = ('title', 'release_date')
+PERFORMANCE_COLUMNS = ('Movie_id', 'Actor_id', 'actor_fee')
+
+def actor_rows(count, rng):
+    names = ['{} {}'.format(first, last) for first in FIRST_NAMES for last in LAST_NAMES]
+    random = rng.random
+    for _ in range(count):
+        yield (names[int(random() * len(names))], GENDERS[random() < 0.5], 8 + int(random() * 83))
+
+def movie_rows(count, rng):
+    titles = list(TITLE_WORDS)
+    titles += ['{} {}'.format(first, second) for first in TITLE_WORDS for second in TITLE_WORDS
+               if first != second]
+    dates = [FIRST_RELEASE + timedelta(days=day) for day in range(75 * 365)]
+    random = rng.random
+    for _ in range(count):
+        yield (titles[int(random() * len(titles))], dates[int(random() * len(dates))])
+
+def performance_rows(count, movies, actors, rng):
+    '''
+    count distinct (movie, actor) castings over ids 1..movies and 1..actors
+    movie i % movies gets actor (offset + i // movies) % actors, so pairs never repeat
+    '''
+    count = min(count, movies * actors)
+    random = rng.random
+    offsets = [int(random() * actors) for _ in range(movies)]
+    for i in range(count):
+        movie = i % movies
+        yield (movie + 1, (offsets[movie] + i // movies) % actors + 1,
+               FEES[int(random() * len(FEES))])
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _copy_chunk(connection, table, columns, chunk):
+    '''loads chunk with PostgreSQL COPY ... FROM STDIN, empty fields are NULL'''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ', '.join('"{}"'.format(column) for column in columns)), buffer)
+
+def insert_rows(table, columns, rows, chunk_size=10000, total=None, progress=None):
+    '''
+    inserts rows (tuples in columns order) in chunks, one transaction per chunk:
+    COPY on PostgreSQL, a plain DB-API executemany on SQLite and a Core
+    executemany elsewhere
+    progress(table name, rows inserted so far, total) is called after each chunk
+    returns the number of rows inserted
+    '''
+    dialect = db.engine.dialect.name
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        table.name, ', '.join('"{}"'.format(column) for column in columns),
+        ', '.join('?' for _ in columns))
+    inserted = 0
+    for chunk in _chunks(rows, chunk_size):
+        with db.engine.begin() as connection:
+            if dialect == 'postgresql':
+                _copy_chunk(connection, table, columns, chunk)
+            elif dialect == 'sqlite':
+                connection.connection.cursor().executemany(sql, chunk)
+            else:
+                connection.execute(table.insert(), [dict(zip(columns, row)) for row in chunk])
+        inserted += len(chunk)
+        if progress:
+            progress(table.name, inserted, total)
+    return inserted
+
+def secondary_indexes():
+    return [index for table in (Actor.__table__, Movie.__table__, Performance,
+                                MovieCosts, ActorEarnings)
+            for index in table.indexes]
+
+def previous_versions():
+    '''the table versions before the drop, or {} when there is no table_versions yet'''
+    try:
+        versions = get_versions(*VERSIONED_TABLES)
+    except SQLAlchemyError:
+        db.session.rollback()
+        return {}
+    db.session.commit()
+    return versions
+
+def seed_database(actors, movies, performances, seed=0, chunk_size=10000,
+                  drop_indexes=True, progress=None):
+    '''
+    drops every table and fills fresh ones with synthetic rows
+    the same seed always produces the same data, with ids 1..actors and 1..movies
+
+    the fee summary triggers are off during the load and the summaries are
+    computed once at the end; with drop_indexes the secondary indexes are
+    also dropped first and rebuilt over the loaded rows
+    '''
+    rng = random.Random(seed)
+    versions = previous_versions()
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    dialect = db.engine.dialect.name
+    indexes = secondary_indexes() if drop_indexes else []
+    with db.engine.begin() as connection:
+        for statement in fee_summary_trigger_drops(dialect):
+            connection.execute(statement)
+        for index in indexes:
+            index.drop(bind=connection)
+
+    insert_rows(Actor.__table__, ACTOR_COLUMNS, actor_rows(actors, rng), chunk_size, actors, progress)
+    insert_rows(Movie.__table__, MOVIE_COLUMNS, movie_rows(movies, rng), chunk_size, movies, progress)
+    if actors and movies:
+        performances = min(performances, actors * movies)
+        insert_rows(Performance, PERFORMANCE_COLUMNS, performance_rows(performances, movies, actors, rng),
+                    chunk_size, performances, progress)
+
+    with db.engine.begin() as connection:
+        rebuild_fee_summaries(connection)
+        for index in indexes:
+            if progress:
+                progress('index ' + index.name, None, None)
+            index.create(bind=connection)
+        for statement in fee_summary_triggers(dialect):
+            connection.execute(statement)
+        if dialect == 'postgresql':
+            connection.execute('ANALYZE')
+
+    # the versions go on from where the old tables left them, so an ETag
+    # or a cached response from before the reseed never matches the new rows;
+    # the bump makes running workers drop what they cached
+    for name, version in versions.items():
+        db.session.execute(TableVersions.update()
+                           .where(TableVersions.c.name == name).values(version=version))
+    bump_versions(*VERSIONED_TABLES)
+    db.session.commit()
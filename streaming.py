@@ -0,0 +1,32 @@
+import logging
+from flask import Response, stream_with_context
+from config import export_config
+from encoding import dumps
+
+#----------------------------------------------------------------------------#
+# Streaming NDJSON exports
+#----------------------------------------------------------------------------#
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def ndjson_lines(query, serialize, batch_size=None):
+    '''
+    yields one JSON document per row of query, newline terminated
+    yield_per keeps a server-side cursor open (stream_results on psycopg2),
+    so only batch_size rows are held in memory at any time
+    '''
+    batch_size = batch_size or export_config['EXPORT_BATCH_SIZE']
+    try:
+        for row in query.yield_per(batch_size):
+            yield dumps(serialize(row)) + b'\n'
+    except Exception as e:
+        # headers are already sent, so the client only sees a truncated body
+        logging.exception(e)
+        raise
+
+def ndjson_response(query, serialize, batch_size=None):
+    '''wraps ndjson_lines in a streamed response that keeps the app context alive'''
+    return Response(
+        stream_with_context(ndjson_lines(query, serialize, batch_size)),
+        mimetype=NDJSON_MIMETYPE
+    )